@@ -1,38 +1,165 @@
 import eventlet
 eventlet.monkey_patch()
+from eventlet import tpool
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
 
 import os
 import json
 import random
-from flask import Flask, flash, redirect, render_template, request, session, Response
+from flask import Flask, flash, redirect, render_template, request, session, Response, send_file, g
+from flask.sessions import SessionInterface
 from flask_session import Session
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_socketio import SocketIO, emit, join_room
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, inspect, text, select, func, delete, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
 from functools import wraps
-from PIL import Image, ImageDraw
+from collections import OrderedDict, deque, namedtuple
+from PIL import Image
 import io
-from datetime import datetime
+import itertools
+import re
+import struct
+import zlib
+import atexit
+import hashlib
+import base64
+import secrets
+import time
+import tempfile
+import glob
+import zipfile
+import logging
+from bisect import bisect_left
+from datetime import datetime, timedelta
 
 # --- App & Extension Configuration ---
+# Log lines are "event key=value ..." so they can be grepped or parsed without a JSON pipeline.
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s %(message)s')
+log = logging.getLogger('pixelpub')
+
 app = Flask(__name__)
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "a_very_secret_dev_key_for_local_runs")
+DEV_SECRET_KEY = "a_very_secret_dev_key_for_local_runs"
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", DEV_SECRET_KEY)
 app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
+# Where sessions live: 'cookie' (Flask's signed cookie; nothing stored server-side, works across workers), 'redis'
+# (SESSION_REDIS_URL, defaulting to MESSAGE_QUEUE), 'sqlalchemy' (a sessions table in the app database) or the old
+# per-file 'filesystem' store, which is only shared by workers on one machine. The role lives in the session, so a
+# cookie signed with the public dev key could be forged: cookies are the default only once SECRET_KEY is set.
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'cookie' if 'SECRET_KEY' in os.environ else 'filesystem')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///project.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Write-behind: pixel changes are flushed to the DB every FLUSH_INTERVAL seconds, or sooner once this many history rows are queued.
+app.config['FLUSH_INTERVAL'] = float(os.environ.get('FLUSH_INTERVAL', 2.0))
+app.config['FLUSH_MAX_PENDING'] = int(os.environ.get('FLUSH_MAX_PENDING', 5000))
+# Largest stroke accepted in one log_pixel_history message; anything past this is ignored.
+app.config['HISTORY_MAX_PIXELS'] = int(os.environ.get('HISTORY_MAX_PIXELS', 16384))
+# Largest Socket.IO message accepted; bigger frames are refused by the transport before any handler parses them.
+app.config['MAX_SOCKET_MESSAGE'] = int(os.environ.get('MAX_SOCKET_MESSAGE', 1_000_000))
+# History older than this is compacted away (the per-pixel last-modifier table keeps the hover info) every interval seconds.
+app.config['HISTORY_RETENTION_DAYS'] = float(os.environ.get('HISTORY_RETENTION_DAYS', 30))
+app.config['HISTORY_COMPACT_INTERVAL'] = float(os.environ.get('HISTORY_COMPACT_INTERVAL', 3600))
+# Largest width/height allowed for a new pub; the client loads canvases in tiles, so this is no longer bound by page weight.
+app.config['MAX_CANVAS_SIZE'] = int(os.environ.get('MAX_CANVAS_SIZE', 256))
+# place_pixel broadcasts are buffered per room and sent as one frame every tick.
+app.config['BROADCAST_TICK_MS'] = float(os.environ.get('BROADCAST_TICK_MS', 40))
+# Set to a redis:// URL to run several workers: Socket.IO rooms and canvas deltas are then shared through it.
+app.config['MESSAGE_QUEUE'] = os.environ.get('MESSAGE_QUEUE')
+# Messages kept per pub (in memory and in the DB); the DB is trimmed back to this every CHAT_TRIM_INTERVAL seconds.
+app.config['CHAT_HISTORY'] = int(os.environ.get('CHAT_HISTORY', 100))
+app.config['CHAT_TRIM_INTERVAL'] = float(os.environ.get('CHAT_TRIM_INTERVAL', 300))
+# Token buckets per socket event as [rate per second, burst], for each user/guest and for each room (pub or canvas).
+# place_pixel and log_pixel_history are charged per pixel. Override any of them with RATE_LIMITS='{"send_message": ...}'.
+app.config['RATE_LIMITS'] = {
+    'place_pixel':       {'user': [1000, 2000], 'room': [5000, 10000]},
+    'log_pixel_history': {'user': [400, 20000], 'room': [4000, 40000]},
+    'save_canvas_state': {'user': [5, 20], 'room': [50, 100]},
+    'send_message':      {'user': [1, 5], 'room': [20, 40]},
+    'apply_tool':        {'user': [2, 10], 'room': [20, 40]},
+    'request_history':   {'user': [10, 20], 'room': [200, 400]},
+}
+app.config['RATE_LIMITS'].update(json.loads(os.environ.get('RATE_LIMITS', '{}')))
+# 'drop' discards over-budget events; 'queue' holds them (up to RATE_LIMIT_MAX_WAIT seconds) until tokens free up.
+app.config['RATE_LIMIT_POLICY'] = os.environ.get('RATE_LIMIT_POLICY', 'drop')
+app.config['RATE_LIMIT_MAX_WAIT'] = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 0.5))
+# Recent pixel deltas kept per canvas so a reconnecting client can catch up without refetching tiles.
+app.config['DELTA_LOG_SIZE'] = int(os.environ.get('DELTA_LOG_SIZE', 4096))
+# Seconds a worker loading a canvas waits for the lease owner's live copy before falling back to the DB snapshot.
+app.config['CANVAS_SYNC_TIMEOUT'] = float(os.environ.get('CANVAS_SYNC_TIMEOUT', 2.0))
+# Saved canvases nobody on this worker has used for this many seconds, with their room empty, are dropped from memory.
+app.config['CANVAS_IDLE_SECONDS'] = float(os.environ.get('CANVAS_IDLE_SECONDS', 300))
+app.config['USER_DIRECTORY_PAGE_SIZE'] = int(os.environ.get('USER_DIRECTORY_PAGE_SIZE', 20))
+# Timing/size instrumentation behind /metrics. Set METRICS_ENABLED=0 to skip it entirely; METRICS_TOKEN lets a
+# Prometheus scraper authenticate with "Authorization: Bearer <token>" instead of an admin session.
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Pillow drawing and PNG encoding run on native threads so they don't stall the eventlet hub. RENDER_THREADS caps
+# concurrent renders; once RENDER_QUEUE more are waiting, further image requests get a 503 instead of piling up.
+app.config['RENDER_THREADS'] = int(os.environ.get('RENDER_THREADS', 4))
+app.config['RENDER_QUEUE'] = int(os.environ.get('RENDER_QUEUE', 64))
+# A full snapshot of each canvas is kept at most every KEYFRAME_INTERVAL seconds as a starting point for timelapses.
+app.config['KEYFRAME_INTERVAL'] = float(os.environ.get('KEYFRAME_INTERVAL', 3600))
+app.config['TIMELAPSE_MAX_FRAMES'] = int(os.environ.get('TIMELAPSE_MAX_FRAMES', 300))
+app.config['TIMELAPSE_TTL'] = float(os.environ.get('TIMELAPSE_TTL', 3600))  # Seconds a finished export stays downloadable.
 
 # Add ProxyFix Middleware for deployment
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
-Session(app)
 db = SQLAlchemy(app)
+
+SOCKET_IDENTITY = 'pixelpub.identity'  # WSGI environ key of the identity cached on a Socket.IO connection
+DROPPED_PIXELS = 'pixelpub.dropped'  # environ key of {canvas_id: {(x, y)}} rate-limited since the last log_pixel_history
+
+class SocketSessionInterface(SessionInterface):
+    """Wraps the configured session interface so Socket.IO events after the connect don't load the session again.
+
+    Flask-SocketIO pushes a request context, and so opens the session, for every event, then swaps in its own copy
+    taken at connect time. Once handle_connect() has cached the identity on the connection that load is wasted, so
+    those events get a null session instead.
+    """
+    def __init__(self, inner):
+        self.inner = inner
+
+    def open_session(self, app, request):
+        if SOCKET_IDENTITY in request.environ: return self.inner.make_null_session(app)
+        return self.inner.open_session(app, request)
+
+    def make_null_session(self, app):
+        return self.inner.make_null_session(app)
+
+    def is_null_session(self, obj):
+        return self.inner.is_null_session(obj)
+
+    def save_session(self, app, session, response):
+        return self.inner.save_session(app, session, response)
+
+def configure_sessions():
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'cookie':
+        if app.config['SECRET_KEY'] == DEV_SECRET_KEY: raise ValueError("SESSION_BACKEND=cookie needs SECRET_KEY set to a private value")
+    elif backend in ('redis', 'sqlalchemy', 'filesystem'):
+        if backend == 'redis':
+            import redis  # Only needed for the redis session backend.
+            url = os.environ.get('SESSION_REDIS_URL') or app.config['MESSAGE_QUEUE']
+            if not url: raise ValueError("SESSION_BACKEND=redis needs SESSION_REDIS_URL or MESSAGE_QUEUE")
+            app.config['SESSION_REDIS'] = redis.Redis.from_url(url)
+        if backend == 'sqlalchemy': app.config['SESSION_SQLALCHEMY'] = db
+        app.config['SESSION_TYPE'] = backend
+        Session(app)
+    else:
+        raise ValueError(f"Unsupported SESSION_BACKEND {backend!r}; use cookie, redis, sqlalchemy or filesystem")
+    app.session_interface = SocketSessionInterface(app.session_interface)
+
+configure_sessions()
 # CORRECTED: Set async_mode to 'eventlet' to match the Procfile/Render setup
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', message_queue=app.config['MESSAGE_QUEUE'],
+                    max_http_buffer_size=app.config['MAX_SOCKET_MESSAGE'])
 
 # --- Database Models (SQLAlchemy ORM) ---
 class User(db.Model):
@@ -40,12 +167,15 @@ class User(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     hash = db.Column(db.String(200), nullable=False)
     role = db.Column(db.String(20), nullable=False, default='user')
-    avatar_data = db.Column(db.Text)
+    # Pixel columns are deferred so lists of users don't drag every avatar along; they load together on first access.
+    avatar_data = db.deferred(db.Column(db.Text), group='avatar')  # Legacy JSON grid; migrate_pixel_storage() moves it into avatar_pixels.
+    avatar_pixels = db.deferred(db.Column(db.LargeBinary), group='avatar')
+    avatar_version = db.Column(db.String(16))  # Content hash of the avatar; part of its immutable URL.
 
 class Pub(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    name = db.Column(db.String(100), nullable=False, index=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     is_private = db.Column(db.Boolean, nullable=False, default=False)
     canvas_id = db.Column(db.Integer, db.ForeignKey('canvas.id'), unique=True, nullable=False)
     canvas = db.relationship('Canvas', backref='pub', uselist=False, cascade="all, delete")
@@ -57,13 +187,18 @@ class Canvas(db.Model):
     name = db.Column(db.String(100), nullable=False)
     width = db.Column(db.Integer, nullable=False)
     height = db.Column(db.Integer, nullable=False)
-    canvas_data = db.Column(db.Text)
+    # Deferred like the avatar columns: loading a Canvas for its size shouldn't fetch the whole image.
+    canvas_data = db.deferred(db.Column(db.Text), group='pixels')  # Legacy JSON grid; migrate_pixel_storage() moves it into pixels.
+    pixels = db.deferred(db.Column(db.LargeBinary), group='pixels')
     history = db.relationship('PixelHistory', backref='canvas', cascade="all, delete", lazy='dynamic')
+    last_modifiers = db.relationship('PixelLastModifier', cascade="all, delete", lazy='dynamic')
+    keyframes = db.relationship('CanvasKeyframe', cascade="all, delete", lazy='dynamic')
+    ops = db.relationship('CanvasOp', cascade="all, delete", lazy='dynamic')
 
 class PubMember(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     pub_id = db.Column(db.Integer, db.ForeignKey('pub.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     __table_args__ = (db.UniqueConstraint('pub_id', 'user_id'),)
 
 class ChatMessage(db.Model):
@@ -73,6 +208,7 @@ class ChatMessage(db.Model):
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User')
+    __table_args__ = (db.Index('ix_chat_message_pub_time', 'pub_id', 'timestamp'),)
 
 class Friendship(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -80,7 +216,8 @@ class Friendship(db.Model):
     user_two_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     status = db.Column(db.String(20), nullable=False)
     action_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    __table_args__ = (db.UniqueConstraint('user_one_id', 'user_two_id'),)
+    # The unique constraint already indexes lookups by user_one_id; this covers the other side of the pair.
+    __table_args__ = (db.UniqueConstraint('user_one_id', 'user_two_id'), db.Index('ix_friendship_user_two', 'user_two_id', 'user_one_id'))
 
 class PixelHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -91,6 +228,1337 @@ class PixelHistory(db.Model):
     color = db.Column(db.String(7), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User')
+    __table_args__ = (db.Index('ix_pixel_history_pixel', 'canvas_id', 'x', 'y', 'timestamp'),)
+
+class PixelLastModifier(db.Model):
+    # Latest history entry or tool op for each pixel, upserted on every flush so hover lookups are a primary-key read.
+    canvas_id = db.Column(db.Integer, db.ForeignKey('canvas.id'), primary_key=True)
+    x = db.Column(db.Integer, primary_key=True)
+    y = db.Column(db.Integer, primary_key=True)
+    modifier_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+class CanvasKeyframe(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    canvas_id = db.Column(db.Integer, db.ForeignKey('canvas.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    pixels = db.Column(db.LargeBinary, nullable=False)  # Same format as Canvas.pixels.
+    __table_args__ = (db.Index('ix_canvas_keyframe_canvas_time', 'canvas_id', 'timestamp'),)
+
+class CanvasOp(db.Model):
+    # One fill/rectangle/line edit stored as the scanline spans it painted, so a big fill is one history row, not thousands.
+    id = db.Column(db.Integer, primary_key=True)
+    canvas_id = db.Column(db.Integer, db.ForeignKey('canvas.id'), nullable=False)
+    modifier_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    tool = db.Column(db.String(8), nullable=False)
+    color = db.Column(db.String(7), nullable=False)
+    # Bounding box of the painted pixels, so the ops that touched an area can be found without decoding spans.
+    x0 = db.Column(db.Integer, nullable=False)
+    y0 = db.Column(db.Integer, nullable=False)
+    x1 = db.Column(db.Integer, nullable=False)
+    y1 = db.Column(db.Integer, nullable=False)
+    spans = db.deferred(db.Column(db.LargeBinary, nullable=False))  # See encode_spans().
+    timestamp = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.Index('ix_canvas_op_canvas_time', 'canvas_id', 'timestamp'),)
+
+# --- Pixel Storage Codec ---
+# Canvases and avatars are stored as one format byte followed by zlib-compressed packed RGB (3 bytes per pixel,
+# row-major). Flat-colour pixel art compresses to a few bytes per row, versus ~11 bytes per pixel as JSON.
+PIXEL_FORMAT_ZLIB_RGB = 1
+WHITE_RGB = b'\xff\xff\xff'
+AVATAR_SIZE = 32
+TILE_SIZE = 32
+
+def as_int(value):
+    """Coerce a client-supplied id/coordinate to int, returning None on garbage."""
+    try: return int(value)
+    except (TypeError, ValueError): return None
+
+def parse_color(color):
+    """Return the three RGB bytes of a '#RRGGBB' string, or None if it is malformed."""
+    if not isinstance(color, str) or len(color) != 7 or color[0] != '#': return None
+    try: return bytes.fromhex(color[1:])
+    except ValueError: return None
+
+COLOR_RE = re.compile(r'#[0-9a-fA-F]{6}\Z')
+
+def validate_pixels(pixels, width, height, limit):
+    """
+    Check a batch of client pixels ({'x', 'y', 'color'} dicts) against a canvas's dimensions in one pass, returning
+    [(x, y, rgb)] for the valid ones among the first `limit`. Coordinates must be real ints; colours are decoded
+    with a single bytes.fromhex over the whole batch rather than one parse per pixel.
+    """
+    valid = [(p['x'], p['y'], p['color']) for p in pixels[:limit]
+             if type(p) is dict and type(p.get('x')) is int and type(p.get('y')) is int
+             and 0 <= p['x'] < width and 0 <= p['y'] < height and type(p.get('color')) is str and COLOR_RE.match(p['color'])]
+    rgb = bytes.fromhex(''.join(color[1:] for _, _, color in valid))
+    return [(x, y, rgb[i * 3:i * 3 + 3]) for i, (x, y, _) in enumerate(valid)]
+
+def encode_pixels(rgb):
+    """Pack raw RGB bytes into the storage format."""
+    return bytes([PIXEL_FORMAT_ZLIB_RGB]) + zlib.compress(bytes(rgb), 6)
+
+def decode_pixels(blob, width, height):
+    """Unpack a stored blob back to raw RGB bytes, checking it matches the expected dimensions."""
+    if blob[0] != PIXEL_FORMAT_ZLIB_RGB: raise ValueError(f"Unknown pixel format {blob[0]}")
+    rgb = zlib.decompress(blob[1:])
+    if len(rgb) != width * height * 3: raise ValueError("Pixel data does not match canvas dimensions")
+    return rgb
+
+def encode_spans(spans):
+    """Pack [(y, x0, x1)] runs (inclusive) as zlib-compressed little-endian uint16 triples."""
+    return zlib.compress(struct.pack(f'<{len(spans) * 3}H', *(v for span in spans for v in span)), 6)
+
+def decode_spans(blob):
+    raw = zlib.decompress(blob)
+    flat = struct.unpack(f'<{len(raw) // 2}H', raw)
+    return list(zip(flat[0::3], flat[1::3], flat[2::3]))
+
+def grid_to_rgb(grid, width, height):
+    """Convert the legacy list-of-rows of hex strings to raw RGB bytes, padding bad or missing cells with white."""
+    rgb = bytearray(WHITE_RGB * (width * height))
+    for y, row in enumerate((grid or [])[:height]):
+        if not isinstance(row, list): continue
+        for x, color in enumerate(row[:width]):
+            value = parse_color(color)
+            if value:
+                i = (y * width + x) * 3
+                rgb[i:i + 3] = value
+    return bytes(rgb)
+
+def rgb_to_grid(rgb, width):
+    """Convert raw RGB bytes to the list-of-rows of '#rrggbb' strings the JS editors work with."""
+    hexed, row_len = bytes(rgb).hex(), width * 6
+    return [['#' + hexed[r + c:r + c + 6] for c in range(0, row_len, 6)] for r in range(0, len(hexed), row_len)]
+
+def blank_pixels(width, height):
+    return encode_pixels(WHITE_RGB * (width * height))
+
+def load_pixels(blob, legacy_json, width, height):
+    """Read pixels from the binary column, falling back to a not-yet-migrated JSON grid, then to white."""
+    if blob:
+        try: return decode_pixels(blob, width, height)
+        except (ValueError, zlib.error): pass
+    if legacy_json:
+        try: return grid_to_rgb(json.loads(legacy_json), width, height)
+        except ValueError: pass
+    return WHITE_RGB * (width * height)
+
+def load_canvas_rgb(canvas):
+    return load_pixels(canvas.pixels, canvas.canvas_data, canvas.width, canvas.height)
+
+def load_avatar_rgb(user):
+    """Raw RGB of a user's avatar, or None if they never saved one."""
+    if not user or not (user.avatar_pixels or user.avatar_data): return None
+    return load_pixels(user.avatar_pixels, user.avatar_data, AVATAR_SIZE, AVATAR_SIZE)
+
+def avatar_version(rgb):
+    return hashlib.blake2b(rgb, digest_size=8).hexdigest() if rgb else None
+
+def set_avatar(user, rgb):
+    user.avatar_pixels, user.avatar_data, user.avatar_version = encode_pixels(rgb), None, avatar_version(rgb)
+
+def avatar_url(user_id, version):
+    """Immutable URL of one revision of an avatar; saving a new avatar changes the version and so busts caches."""
+    return f"/avatar/{user_id}/{version or 'blank'}.png"
+
+def _add_missing_columns(model, column_names):
+    """create_all() never alters existing tables, so add new nullable columns by hand."""
+    table = model.__table__
+    existing = {c['name'] for c in inspect(db.engine).get_columns(table.name)}
+    with db.engine.begin() as conn:
+        for name in column_names:
+            if name not in existing:
+                column_type = table.c[name].type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {name} {column_type}'))
+
+def create_missing_indexes():
+    """create_all() skips indexes on tables that already exist, so create any that are missing."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def migrate_pixel_storage(batch_size=200):
+    """Move legacy JSON canvas and avatar grids into the binary columns. Safe to run repeatedly."""
+    _add_missing_columns(Canvas, ['pixels'])
+    _add_missing_columns(User, ['avatar_pixels', 'avatar_version'])
+    migrated = 0
+    while True:
+        canvases = Canvas.query.filter(Canvas.pixels == None, Canvas.canvas_data != None).limit(batch_size).all()
+        users = User.query.filter(User.avatar_version == None, or_(User.avatar_pixels != None, User.avatar_data != None)).limit(batch_size).all()
+        if not canvases and not users: break
+        for canvas in canvases:
+            canvas.pixels, canvas.canvas_data = encode_pixels(load_canvas_rgb(canvas)), None
+        for user in users:
+            set_avatar(user, load_avatar_rgb(user))
+        db.session.commit()
+        migrated += len(canvases) + len(users)
+    return migrated
+
+def migrate_pixel_history():
+    """Backfill PixelLastModifier from the history table if it is empty."""
+    if db.session.query(PixelLastModifier.canvas_id).first(): return 0
+    latest_ids = select(func.max(PixelHistory.id)).group_by(PixelHistory.canvas_id, PixelHistory.x, PixelHistory.y)
+    columns = ['canvas_id', 'x', 'y', 'modifier_id', 'timestamp']
+    result = db.session.execute(PixelLastModifier.__table__.insert().from_select(
+        columns, select(*[PixelHistory.__table__.c[c] for c in columns]).where(PixelHistory.id.in_(latest_ids))))
+    db.session.commit()
+    return result.rowcount
+
+def compact_pixel_history(max_age_days):
+    """Delete history rows and tool ops older than max_age_days. The hover info lives on in PixelLastModifier, which
+    every flush already updates for placed pixels and tool ops alike.
+
+    Keyframes that old go too, except the newest one of each canvas, which timelapses still replay from.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    result = db.session.execute(delete(PixelHistory).where(PixelHistory.timestamp < cutoff))
+    db.session.execute(delete(CanvasOp).where(CanvasOp.timestamp < cutoff))
+    newest_old = select(func.max(CanvasKeyframe.id)).where(CanvasKeyframe.timestamp < cutoff).group_by(CanvasKeyframe.canvas_id)
+    db.session.execute(delete(CanvasKeyframe).where(CanvasKeyframe.timestamp < cutoff, CanvasKeyframe.id.notin_(newest_old)))
+    db.session.commit()
+    return result.rowcount
+
+def trim_chat_messages(pub_ids, keep):
+    """Delete all but the newest `keep` messages of each pub."""
+    deleted = 0
+    for pub_id in pub_ids:
+        newest = select(ChatMessage.id).filter_by(pub_id=pub_id).order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(keep)
+        # Materialise the ids first: MySQL-style engines reject a LIMIT subquery inside NOT IN.
+        keep_ids = db.session.execute(newest).scalars().all()
+        deleted += db.session.execute(delete(ChatMessage).where(ChatMessage.pub_id == pub_id, ChatMessage.id.notin_(keep_ids))).rowcount
+    db.session.commit()
+    return deleted
+
+# --- Cross-Worker Message Bus ---
+# Every worker keeps its own in-memory canvases. Pixel deltas are published on the bus and applied by every worker
+# (the publisher included) in the order the bus delivers them, so all copies converge. Only the worker holding a
+# canvas's lease writes its snapshot to the DB; the lease lapses if that worker dies and another one takes over.
+WORKER_ID = secrets.token_hex(4)
+
+class LocalBus:
+    """In-process bus for a single worker (and for tests): publish() calls subscribers synchronously."""
+    shared = False  # No other worker can hold state the DB hasn't seen yet.
+
+    def __init__(self):
+        self._handlers = {}
+        self._leases = {}  # key -> (owner, expiry on the monotonic clock)
+
+    def start(self):
+        pass
+
+    def subscribe(self, channel, handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def publish(self, channel, message):
+        for handler in self._handlers.get(channel, ()):
+            handler(message)
+
+    def claim(self, key, owner, ttl):
+        """Take or renew a lease. Returns True if `owner` holds it afterwards."""
+        holder, expires = self._leases.get(key, (None, 0))
+        now = time.monotonic()
+        if holder not in (None, owner) and expires > now: return False
+        self._leases[key] = (owner, now + ttl)
+        return True
+
+class RedisBus:
+    """Redis pub/sub bus shared by every worker pointed at the same MESSAGE_QUEUE."""
+    PREFIX = 'pixelpub:'
+    shared = True
+
+    def __init__(self, url):
+        import redis  # Only needed when running multiple workers.
+        self._redis = redis.Redis.from_url(url)
+        self._handlers = {}
+        self._started = False
+
+    def start(self):
+        if self._started: return
+        self._started = True
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*[self.PREFIX + channel for channel in self._handlers])
+        socketio.start_background_task(self._listen, pubsub)
+
+    def _listen(self, pubsub):
+        for item in pubsub.listen():
+            channel, message = item['channel'].decode()[len(self.PREFIX):], json.loads(item['data'])
+            for handler in self._handlers.get(channel, ()):
+                try: handler(message)
+                except Exception: log.exception("bus_handler_failed channel=%s", channel)
+
+    def subscribe(self, channel, handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def publish(self, channel, message):
+        self._redis.publish(self.PREFIX + channel, json.dumps(message))
+
+    def claim(self, key, owner, ttl):
+        key, ttl_ms = self.PREFIX + 'lease:' + key, int(ttl * 1000)
+        if self._redis.set(key, owner, nx=True, px=ttl_ms): return True
+        if self._redis.get(key) == owner.encode():
+            self._redis.pexpire(key, ttl_ms)
+            return True
+        return False
+
+def make_bus(url):
+    if not url: return LocalBus()
+    if url.startswith(('redis://', 'rediss://')): return RedisBus(url)
+    raise ValueError(f"Unsupported MESSAGE_QUEUE {url!r}; use a redis:// URL")
+
+canvas_bus = make_bus(app.config['MESSAGE_QUEUE'])
+
+# --- Off-Hub Image Rendering ---
+class RenderQueueFull(Exception):
+    pass
+
+class Renderer:
+    """
+    Runs CPU-bound image work in eventlet's native thread pool (tpool). Only `threads` renders execute at once and at
+    most `max_queue` more may wait; beyond that `run` raises RenderQueueFull. Calls sharing a `key` while one is in
+    flight wait for that render instead of starting their own.
+    """
+    def __init__(self, threads, max_queue):
+        tpool.set_num_threads(threads)
+        self._slots, self.max_queue = Semaphore(threads), max_queue
+        self._inflight = {}  # key -> Event fired with the shared result
+        self.waiting = 0
+
+    def run(self, key, f, *args):
+        if key is not None and key in self._inflight:
+            metrics.inc('pixelpub_renders_coalesced_total')
+            return self._inflight[key].wait()
+        if self._slots.locked() and self.waiting >= self.max_queue: raise RenderQueueFull()
+        done = Event()
+        if key is not None: self._inflight[key] = done
+        try:
+            self.waiting += 1
+            try: self._slots.acquire()
+            finally: self.waiting -= 1
+            try:
+                start = time.perf_counter()
+                result = tpool.execute(f, *args)
+                metrics.observe('pixelpub_render_seconds', time.perf_counter() - start, kind=f.__name__)
+            finally: self._slots.release()
+        except Exception as e:
+            done.send_exception(e)
+            raise
+        else:
+            done.send(result)
+            return result
+        finally:
+            if key is not None: self._inflight.pop(key, None)
+
+renderer = Renderer(app.config['RENDER_THREADS'], app.config['RENDER_QUEUE'])
+
+def encode_png(pixels, width, height):
+    """PNG of raw RGB bytes. Pass a private copy: it runs on a native thread while the hub keeps mutating canvases."""
+    img_io = io.BytesIO()
+    Image.frombytes('RGB', (width, height), pixels).save(img_io, 'PNG')
+    return img_io.getvalue()
+
+# --- In-Memory Canvas Engine ---
+# Drawing tools work on scanline spans: (y, x0, x1) runs with both ends inclusive.
+TOOL_POINTS = {'fill': 1, 'rect': 2, 'line': 2}  # Canvas points each tool takes.
+
+def rect_spans(x0, y0, x1, y1):
+    (x0, x1), (y0, y1) = sorted((x0, x1)), sorted((y0, y1))
+    return [(y, x0, x1) for y in range(y0, y1 + 1)]
+
+def line_spans(x0, y0, x1, y1):
+    """Bresenham line, with horizontally adjacent pixels merged into one span."""
+    dx, dy = abs(x1 - x0), -abs(y1 - y0)
+    sx, sy = 1 if x0 < x1 else -1, 1 if y0 < y1 else -1
+    err, spans = dx + dy, []
+    while True:
+        last = spans[-1] if spans else None
+        if last and last[0] == y0 and last[1] - 1 <= x0 <= last[2] + 1: spans[-1] = (y0, min(last[1], x0), max(last[2], x0))
+        else: spans.append((y0, x0, x0))
+        if x0 == x1 and y0 == y1: return spans
+        e2 = 2 * err
+        if e2 >= dy: err, x0 = err + dy, x0 + sx
+        if e2 <= dx: err, y0 = err + dx, y0 + sy
+
+class CanvasState:
+    """Server-authoritative pixels of one canvas, held as a flat RGB bytearray (3 bytes per pixel)."""
+    def __init__(self, canvas_id, width, height, pixels=None):
+        self.id, self.width, self.height = canvas_id, width, height
+        self.pixels = bytearray(pixels) if pixels else bytearray(WHITE_RGB * (width * height))
+        self.dirty = False
+        self.version, self.modified_at = 0, datetime.utcnow()
+        # Versions restart from 0 whenever a process loads the canvas, so clients compare them only within one epoch.
+        self.epoch = secrets.token_hex(4)
+        self.tiles_x, self.tiles_y = -(-width // TILE_SIZE), -(-height // TILE_SIZE)
+        self.tile_versions = [0] * (self.tiles_x * self.tiles_y)
+        self.keyframe_at = None  # Time of the newest CanvasKeyframe, looked up on the first flush.
+        self.deltas = deque(maxlen=app.config['DELTA_LOG_SIZE'])  # (version, x, y, 'rrggbb') of the latest changes
+        self.used_at = time.monotonic()  # Last CanvasStore.get(); deltas arriving over the bus don't count.
+
+    def set_pixel(self, x, y, rgb):
+        """Apply one delta. Returns True if the pixel actually changed."""
+        if not (0 <= x < self.width and 0 <= y < self.height): return False
+        i = (y * self.width + x) * 3
+        if self.pixels[i:i + 3] == rgb: return False
+        self.pixels[i:i + 3] = rgb
+        self.dirty = True
+        self.version += 1
+        self.modified_at = datetime.utcnow()
+        self.tile_versions[(y // TILE_SIZE) * self.tiles_x + x // TILE_SIZE] = self.version
+        self.deltas.append((self.version, x, y, rgb.hex()))
+        return True
+
+    def flood_spans(self, x, y, rgb):
+        """Scanline flood fill: the spans of the 4-connected region of (x, y)'s colour, or [] if it is already `rgb`."""
+        w, h, px = self.width, self.height, self.pixels
+        i = (y * w + x) * 3
+        target = bytes(px[i:i + 3])
+        if target == rgb: return []
+        seen, spans, stack = bytearray(w * h), [], [(x, y)]
+        while stack:
+            x, y = stack.pop()
+            if seen[y * w + x]: continue
+            row = y * w * 3
+            x0, x1 = x, x
+            while x0 > 0 and px[row + (x0 - 1) * 3:row + x0 * 3] == target: x0 -= 1
+            while x1 < w - 1 and px[row + (x1 + 1) * 3:row + (x1 + 2) * 3] == target: x1 += 1
+            seen[y * w + x0:y * w + x1 + 1] = b'\x01' * (x1 - x0 + 1)
+            spans.append((y, x0, x1))
+            # Seed the rows above and below once per run of matching pixels alongside this span.
+            for ny in (y - 1, y + 1):
+                if not 0 <= ny < h: continue
+                nrow, inside = ny * w * 3, False
+                for nx in range(x0, x1 + 1):
+                    match = not seen[ny * w + nx] and px[nrow + nx * 3:nrow + nx * 3 + 3] == target
+                    if match and not inside: stack.append((nx, ny))
+                    inside = match
+        return spans
+
+    def tool_spans(self, tool, points, rgb):
+        """Spans a tool paints given its flat [x, y, ...] points, which must already be on the canvas."""
+        if tool == 'fill': return self.flood_spans(points[0], points[1], rgb)
+        if tool == 'rect': return rect_spans(*points)
+        if tool == 'line': return line_spans(*points)
+        return []
+
+    def paint_spans(self, spans, rgb):
+        """Apply a tool's spans as slice writes. Returns the pixel count.
+
+        Each pixel still gets its own version and delta, as with set_pixel, so resync stays exact; an edit bigger than
+        the delta log clears it instead, sending clients from before the edit back to the tile manifest.
+        """
+        count = sum(x1 - x0 + 1 for _, x0, x1 in spans)
+        if not count: return 0
+        color, log_deltas = rgb.hex(), count < self.deltas.maxlen
+        if not log_deltas: self.deltas.clear()
+        for y, x0, x1 in spans:
+            n, i = x1 - x0 + 1, (y * self.width + x0) * 3
+            self.pixels[i:i + n * 3] = rgb * n
+            if log_deltas: self.deltas.extend((self.version + 1 + k, x0 + k, y, color) for k in range(n))
+            self.version += n
+            for tx in range(x0 // TILE_SIZE, x1 // TILE_SIZE + 1): self.tile_versions[(y // TILE_SIZE) * self.tiles_x + tx] = self.version
+        self.dirty, self.modified_at = True, datetime.utcnow()
+        return count
+
+    def resync(self, epoch, since):
+        """What a client at version `since` of `epoch` needs to catch up: the missed deltas as a flat [x, y, 'rrggbb', ...]
+        list if the log still reaches back that far, otherwise 'full' so it refetches changed tiles."""
+        reply = {'epoch': self.epoch, 'version': self.version}
+        oldest = self.deltas[0][0] if self.deltas else self.version + 1
+        if epoch != self.epoch or since is None or since > self.version or since + 1 < oldest:
+            reply['full'] = True
+        else:
+            reply['p'] = [v for version, x, y, color in self.deltas if version > since for v in (x, y, color)]
+        return reply
+
+    def changed_tiles(self, since=0):
+        """[tx, ty, version] of every tile changed after `since` (every tile when since is 0)."""
+        return [[i % self.tiles_x, i // self.tiles_x, v] for i, v in enumerate(self.tile_versions) if v > since or not since]
+
+    def tile_rgb(self, tx, ty):
+        """Raw RGB rows of one tile, clipped at the right and bottom edges. None if the tile is out of range."""
+        if not (0 <= tx < self.tiles_x and 0 <= ty < self.tiles_y): return None
+        x0, x1 = tx * TILE_SIZE * 3, min((tx + 1) * TILE_SIZE, self.width) * 3
+        row_bytes = self.width * 3
+        return b''.join(self.pixels[y * row_bytes + x0:y * row_bytes + x1] for y in range(ty * TILE_SIZE, min((ty + 1) * TILE_SIZE, self.height)))
+
+class CanvasStore:
+    """Process-wide cache of CanvasState objects, loaded from the DB on first use and written back on save()."""
+    def __init__(self):
+        self._states = {}
+        self._previews = {}  # canvas_id -> (version, png, etag, last_modified)
+        self._loading = {}  # canvas_id -> {'state', 'buffer', 'synced', 'done'} while catching up with the bus
+
+    def get(self, canvas_id):
+        state = self._states.get(canvas_id)
+        if state is not None: state.used_at = time.monotonic()
+        if state is not None or canvas_id is None: return state
+        if canvas_id in self._loading: return self._loading[canvas_id]['done'].wait()
+        canvas = db.session.get(Canvas, canvas_id)
+        if not canvas: return None
+        # Another greenlet may have started loading the same canvas while we were in the DB; share its copy.
+        if canvas_id in self._states: return self._states[canvas_id]
+        if canvas_id in self._loading: return self._loading[canvas_id]['done'].wait()
+        state = CanvasState(canvas.id, canvas.width, canvas.height, load_canvas_rgb(canvas))
+        if canvas_bus.shared: self._sync(state)
+        self._states[canvas_id] = state
+        return state
+
+    def _sync(self, state):
+        """Bring a copy just read from the DB up to date with the other workers.
+
+        The lease owner may hold deltas it hasn't flushed yet, so we ask it for its live pixels over the canvas channel.
+        Our own request comes back to us at the point in bus order where the owner copies its pixels; deltas from there
+        on are buffered and replayed on top of the owner's copy, or on the DB copy if no owner answers in time.
+
+        If nobody holds the lease there is nothing to ask for: a worker with unsaved changes renews it on every flush.
+        We take it ourselves and keep the DB copy, replaying whatever arrived while the lease was being claimed.
+        """
+        loading = self._loading[state.id] = {'state': state, 'buffer': [], 'synced': Event(), 'done': Event()}
+        try:
+            if not self.owns(state.id):
+                loading['buffer'] = None  # The owner's copy will include everything up to our request.
+                canvas_bus.publish('canvas', {'origin': WORKER_ID, 'canvas_id': state.id, 'sync': 'request'})
+                if loading['synced'].wait(app.config['CANVAS_SYNC_TIMEOUT']) is None:
+                    log.warning("canvas_sync_timeout canvas=%s", state.id)
+            self._states[state.id] = state
+            for message in loading['buffer'] or (): self.apply(message)
+        finally:
+            self._loading.pop(state.id, None)
+            loading['done'].send(state)
+
+    def _answer_sync(self, message):
+        loading = self._loading.get(message['canvas_id'])
+        if message['sync'] == 'request':
+            if message['origin'] == WORKER_ID:
+                if loading and loading['buffer'] is None: loading['buffer'] = []
+                return
+            state = self._states.get(message['canvas_id'])
+            if state and self.owns(state.id):
+                canvas_bus.publish('canvas', {'origin': WORKER_ID, 'canvas_id': state.id, 'sync': 'snapshot', 'for': message['origin'],
+                                              'pixels': base64.b64encode(encode_pixels(state.pixels)).decode()})
+        elif message['for'] == WORKER_ID and loading and loading['buffer'] is not None and not loading['synced'].ready():
+            state = loading['state']
+            state.pixels[:] = decode_pixels(base64.b64decode(message['pixels']), state.width, state.height)
+            state.dirty = True  # The owner's copy may be ahead of the DB; write it if the lease comes to us.
+            loading['synced'].send(True)
+
+    def publish_pixel(self, room, canvas_id, x, y, rgb):
+        """Send a delta to every worker. It is applied here too, when the bus hands it back in order."""
+        canvas_bus.publish('canvas', {'origin': WORKER_ID, 'room': room, 'canvas_id': canvas_id, 'x': x, 'y': y, 'color': rgb.hex()})
+
+    def publish_tool(self, room, canvas_id, tool, points, rgb, user_id):
+        """Send a fill/shape to every worker as its parameters; each one computes the spans against its own copy."""
+        canvas_bus.publish('canvas', {'origin': WORKER_ID, 'room': room, 'canvas_id': canvas_id, 'tool': tool, 'points': points,
+                                      'color': rgb.hex(), 'user_id': user_id})
+
+    def apply(self, message):
+        if 'sync' in message: return self._answer_sync(message)
+        state = self._states.get(message['canvas_id'])  # Workers that haven't loaded the canvas read it from the DB later.
+        if state is None:
+            loading = self._loading.get(message['canvas_id'])
+            # Deltas from before our sync request are in the owner's copy; later ones are replayed once it arrives.
+            if loading and loading['buffer'] is not None: loading['buffer'].append(message)
+            return
+        rgb = bytes.fromhex(message['color'])
+        if 'tool' in message:
+            # Applied in bus order like single pixels, so every worker's flood fill sees the same canvas.
+            spans = state.tool_spans(message['tool'], message['points'], rgb)
+            if state.paint_spans(spans, rgb) and message['origin'] == WORKER_ID:
+                broadcaster.send_tool(message['room'], state.id, message['tool'], spans, message['color'])
+                ys = [y for y, _, _ in spans]
+                write_behind.queue_op({'canvas_id': state.id, 'modifier_id': message['user_id'], 'tool': message['tool'], 'color': '#' + message['color'],
+                                       'x0': min(x0 for _, x0, _ in spans), 'y0': min(ys), 'x1': max(x1 for _, _, x1 in spans), 'y1': max(ys),
+                                       'spans': encode_spans(spans), 'timestamp': datetime.utcnow()})
+            return
+        # Each worker's clients are reached through the Socket.IO message queue, so only the origin broadcasts.
+        if state.set_pixel(message['x'], message['y'], rgb) and message['origin'] == WORKER_ID:
+            broadcaster.queue(message['room'], state.id, message['x'], message['y'], rgb)
+
+    def owns(self, canvas_id):
+        """Take or renew this worker's lease on writing the canvas to the DB."""
+        return canvas_bus.claim(f"canvas:{canvas_id}", WORKER_ID, max(10, 5 * app.config['FLUSH_INTERVAL']))
+
+    def __len__(self):
+        return len(self._states)
+
+    def peek(self, canvas_id):
+        """The loaded state, or None, without touching the DB."""
+        return self._states.get(canvas_id)
+
+    def stage(self, canvas_id):
+        """Add the in-memory copy to the current DB session if it has unsaved changes. Returns True if staged."""
+        state = self._states.get(canvas_id)
+        if not state or not state.dirty: return False
+        state.dirty = False
+        canvas = db.session.get(Canvas, canvas_id)
+        if not canvas:
+            self._states.pop(canvas_id, None)
+            return False
+        canvas.pixels, canvas.canvas_data = encode_pixels(state.pixels), None
+        now = datetime.utcnow()
+        if state.keyframe_at is None:
+            state.keyframe_at = db.session.query(func.max(CanvasKeyframe.timestamp)).filter_by(canvas_id=canvas_id).scalar() or datetime.min
+        if (now - state.keyframe_at).total_seconds() >= app.config['KEYFRAME_INTERVAL']:
+            db.session.add(CanvasKeyframe(canvas_id=canvas_id, timestamp=now, pixels=canvas.pixels))
+            state.keyframe_at = now
+        return True
+
+    def save(self, canvas_id):
+        """Persist the in-memory copy if it has unsaved changes. Returns True if a write happened."""
+        if not self.stage(canvas_id): return False
+        db.session.commit()
+        return True
+
+    def dirty_ids(self):
+        """Canvases with unsaved changes that this worker is responsible for writing."""
+        return [canvas_id for canvas_id, state in list(self._states.items()) if state.dirty and self.owns(canvas_id)]
+
+    def mark_dirty(self, canvas_id):
+        state = self._states.get(canvas_id)
+        if state: state.dirty = True
+
+    def evict(self, canvas_id):
+        self._states.pop(canvas_id, None)
+        self._previews.pop(canvas_id, None)
+        write_behind.discard(canvas_id)
+
+    def evict_idle(self, max_idle):
+        """Free canvases that are saved, unused for max_idle seconds and have nobody in their room on this worker.
+        They are loaded again (from the owner or the DB) on next use. Returns how many were dropped."""
+        cutoff, evicted = time.monotonic() - max_idle, 0
+        rooms = socketio.server.manager.rooms.get('/', {}) if socketio.server else {}
+        for canvas_id, state in list(self._states.items()):
+            if state.dirty or state.used_at > cutoff: continue
+            pub = pub_directory.by_canvas(canvas_id)
+            if pub and rooms.get(f"pub_{pub.id}"): continue
+            self._states.pop(canvas_id, None)
+            self._previews.pop(canvas_id, None)
+            evicted += 1
+        return evicted
+
+    def preview(self, canvas_id):
+        """PNG of a canvas as (png_bytes, etag, last_modified), re-rendered only when its version has moved on."""
+        state = self.get(canvas_id)
+        if state is None: return None
+        cached = self._previews.get(canvas_id)
+        if cached and cached[0] == state.version: return cached[1:]
+        version, pixels, modified_at = state.version, bytes(state.pixels), state.modified_at
+        # Requests arriving while this version renders share the result, keyed by epoch so a reloaded canvas can't match.
+        png = renderer.run(('preview', canvas_id, state.epoch, version), encode_png, pixels, state.width, state.height)
+        # Hash the pixels rather than using the version so the ETag survives restarts and matches across workers.
+        entry = (version, png, hashlib.blake2b(pixels, digest_size=16).hexdigest(), modified_at)
+        self._previews[canvas_id] = entry
+        return entry[1:]
+
+canvas_store = CanvasStore()
+canvas_bus.subscribe('canvas', canvas_store.apply)
+
+# --- Write-Behind Flusher ---
+class WriteBehind:
+    """Coalesces canvas snapshots and pixel history rows in memory and writes them in one transaction per flush.
+
+    A background task flushes every `interval` seconds; queueing more than `max_pending` history rows flushes early,
+    so DB writes stay bounded however fast people draw. flush() is also registered with atexit for a clean shutdown.
+    """
+    def __init__(self, interval, max_pending):
+        self.interval, self.max_pending = interval, max_pending
+        self._history = {}  # canvas_id -> list of PixelHistory column dicts
+        self._ops = []  # CanvasOp column dicts
+        self._chat = []  # ChatMessage column dicts
+        self._pending = 0
+        self._chat_pubs = set()  # pubs with messages written since the last trim
+        self._running = False
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            socketio.start_background_task(self._run)
+            socketio.start_background_task(self._compact)
+            socketio.start_background_task(self._trim_chat)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try: self.flush()
+            except Exception: log.exception("flush_failed")
+            try:
+                with app.app_context(): canvas_store.evict_idle(app.config['CANVAS_IDLE_SECONDS'])
+            except Exception: log.exception("canvas_eviction_failed")
+
+    def _compact(self):
+        while True:
+            socketio.sleep(app.config['HISTORY_COMPACT_INTERVAL'])
+            try:
+                with app.app_context(): log.info("history_compacted rows=%d", compact_pixel_history(app.config['HISTORY_RETENTION_DAYS']))
+            except Exception: log.exception("history_compaction_failed")
+
+    def _trim_chat(self):
+        while True:
+            socketio.sleep(app.config['CHAT_TRIM_INTERVAL'])
+            pub_ids, self._chat_pubs = self._chat_pubs, set()
+            try:
+                with app.app_context(): log.info("chat_trimmed pubs=%d rows=%d", len(pub_ids), trim_chat_messages(pub_ids, app.config['CHAT_HISTORY']))
+            except Exception: log.exception("chat_trim_failed")
+
+    def queue_history(self, canvas_id, rows):
+        self._history.setdefault(canvas_id, []).extend(rows)
+        self._pending += len(rows)
+        self.start()
+        if self._pending >= self.max_pending: self.flush()
+
+    def queue_op(self, row):
+        self._ops.append(row)
+        self._pending += 1
+        self.start()
+        if self._pending >= self.max_pending: self.flush()
+
+    def queue_chat(self, row):
+        self._chat.append(row)
+        self._pending += 1
+        self.start()
+        if self._pending >= self.max_pending: self.flush()
+
+    def discard(self, canvas_id):
+        kept = [row for row in self._ops if row['canvas_id'] != canvas_id]
+        self._pending -= len(self._history.pop(canvas_id, ())) + len(self._ops) - len(kept)
+        self._ops = kept
+
+    def discard_chat(self, pub_id):
+        kept = [row for row in self._chat if row['pub_id'] != pub_id]
+        self._pending -= len(self._chat) - len(kept)
+        self._chat = kept
+        self._chat_pubs.discard(pub_id)
+
+    def flush(self):
+        """Write every dirty canvas and all queued rows in one commit.
+
+        Returns (canvases, history records, chat messages) written, where a tool op counts as one history record.
+        """
+        history, ops, chat, self._history, self._ops, self._chat, self._pending = self._history, self._ops, self._chat, {}, [], [], 0
+        dirty = canvas_store.dirty_ids()
+        if not history and not ops and not chat and not dirty: return 0, 0, 0
+        start = time.perf_counter()
+        with app.app_context():
+            try:
+                staged = [canvas_id for canvas_id in dirty if canvas_store.stage(canvas_id)]
+                rows, ops, chat = drop_orphans([row for canvas_rows in history.values() for row in canvas_rows], ops, chat)
+                bulk_insert_history(rows)
+                if ops: db.session.execute(CanvasOp.__table__.insert(), ops)
+                # Ops record every pixel they painted too, merged in time order with the placed ones, so a hover stays
+                # a primary-key read however many fills overlap the pixel.
+                upsert_last_modifiers(sorted(itertools.chain(rows, op_pixels(ops)), key=lambda row: row['timestamp']))
+                if chat: db.session.execute(ChatMessage.__table__.insert(), chat)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Keep the pixels so the next flush retries them; history rows are dropped rather than retried forever.
+                for canvas_id in dirty: canvas_store.mark_dirty(canvas_id)
+                # Chat and tool ops exist nowhere else, so they go back on the front of the queue; drop_orphans() sheds
+                # any whose canvas or pub is deleted meanwhile.
+                self._ops, self._chat = ops + self._ops, chat + self._chat
+                self._pending += len(ops) + len(chat)
+                raise
+        self._chat_pubs.update(row['pub_id'] for row in chat)
+        elapsed = time.perf_counter() - start
+        metrics.observe('pixelpub_flush_seconds', elapsed)
+        metrics.inc('pixelpub_flushed_total', len(staged), kind='canvas')
+        metrics.inc('pixelpub_flushed_total', len(rows), kind='history')
+        metrics.inc('pixelpub_flushed_total', len(ops), kind='op')
+        metrics.inc('pixelpub_flushed_total', len(chat), kind='chat')
+        log.info("flushed canvases=%d history_rows=%d ops=%d chat_messages=%d seconds=%.3f", len(staged), len(rows), len(ops), len(chat), elapsed)
+        return len(staged), len(rows) + len(ops), len(chat)
+
+    @property
+    def pending(self):
+        return self._pending
+
+def drop_orphans(rows, ops, chat):
+    """Filter queued history rows, tool ops and chat down to those whose canvas, pub and user still exist.
+
+    Anything else would fail its foreign key on every flush from now on, taking the valid rows queued with it down too.
+    """
+    def existing(model, ids):
+        ids = set(ids)
+        return set(db.session.execute(select(model.id).where(model.id.in_(ids))).scalars()) if ids else set()
+    canvases = existing(Canvas, [row['canvas_id'] for row in itertools.chain(rows, ops)])
+    pubs = existing(Pub, [row['pub_id'] for row in chat])
+    users = existing(User, [row['modifier_id'] for row in itertools.chain(rows, ops)] + [row['user_id'] for row in chat])
+    kept = ([row for row in rows if row['canvas_id'] in canvases and row['modifier_id'] in users],
+            [row for row in ops if row['canvas_id'] in canvases and row['modifier_id'] in users],
+            [row for row in chat if row['pub_id'] in pubs and row['user_id'] in users])
+    dropped = len(rows) + len(ops) + len(chat) - sum(map(len, kept))
+    if dropped: log.warning("flush_dropped_orphans rows=%d", dropped)
+    return kept
+
+HISTORY_COLUMNS = ('canvas_id', 'x', 'y', 'modifier_id', 'color', 'timestamp')
+
+def bulk_insert_history(rows):
+    """Insert PixelHistory column dicts in the current transaction without building ORM objects.
+
+    Postgres through psycopg2 gets a single COPY; other databases and drivers get one executemany INSERT.
+    """
+    if not rows: return
+    if db.engine.dialect.name == 'postgresql' and db.engine.dialect.driver == 'psycopg2':  # copy_expert is psycopg2's API.
+        buf = io.StringIO()
+        for row in rows:
+            buf.write('\t'.join(str(row[c]) for c in HISTORY_COLUMNS) + '\n')
+        buf.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(f"COPY {PixelHistory.__tablename__} ({', '.join(HISTORY_COLUMNS)}) FROM STDIN", buf)
+    else:
+        db.session.execute(PixelHistory.__table__.insert(), rows)
+
+def op_pixels(ops):
+    """PixelLastModifier rows for every pixel painted by the given CanvasOp column dicts."""
+    for op in ops:
+        for y, x0, x1 in decode_spans(op['spans']):
+            for x in range(x0, x1 + 1): yield {'canvas_id': op['canvas_id'], 'x': x, 'y': y, 'modifier_id': op['modifier_id'], 'timestamp': op['timestamp']}
+
+def upsert_last_modifiers(rows):
+    """Record the newest of `rows` for each pixel in PixelLastModifier."""
+    latest = {}
+    for row in rows:  # Rows arrive in drawing order, so later ones win; one row per pixel keeps ON CONFLICT legal.
+        latest[(row['canvas_id'], row['x'], row['y'])] = {c: row[c] for c in ('canvas_id', 'x', 'y', 'modifier_id', 'timestamp')}
+    values = list(latest.values())
+    if not values: return
+    table = PixelLastModifier.__table__
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(db.engine.dialect.name)
+    if dialect:
+        stmt = dialect.insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=['canvas_id', 'x', 'y'],
+                                          set_={'modifier_id': stmt.excluded.modifier_id, 'timestamp': stmt.excluded.timestamp})
+        db.session.execute(stmt, values)
+    else:
+        for value in values:
+            db.session.merge(PixelLastModifier(**value))
+
+write_behind = WriteBehind(app.config['FLUSH_INTERVAL'], app.config['FLUSH_MAX_PENDING'])
+atexit.register(write_behind.flush)
+
+# --- Pixel Broadcast Coalescing ---
+class PixelBroadcaster:
+    """Buffers placed pixels per room and sends each room one `pixels_placed` frame per tick.
+
+    The frame is a flat [x, y, 'rrggbb', x, y, 'rrggbb', ...] list in placement order, with repeat placements of the same
+    pixel within a tick collapsed to the last colour. It goes to everyone in the room, including the drawers themselves,
+    so every client applies the server's ordering, and carries the canvas epoch and version ('e', 'v') for resyncing.
+    """
+    def __init__(self, tick):
+        self.tick = tick
+        self._pending = {}  # room -> (canvas_id, {(x, y): 'rrggbb'})
+        self._running = False
+        self.stats = {'pixels_queued': 0, 'pixels_sent': 0, 'frames_sent': 0, 'tools_sent': 0}
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.tick)
+            try: self.flush()
+            except Exception: log.exception("pixel_broadcast_failed")
+
+    def queue(self, room, canvas_id, x, y, rgb):
+        pixels = self._pending.setdefault(room, (canvas_id, {}))[1]
+        pixels.pop((x, y), None)  # Re-insert so the pixel moves to the end of the placement order.
+        pixels[(x, y)] = rgb.hex()
+        self.stats['pixels_queued'] += 1
+        self.start()
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        for room, (canvas_id, pixels) in pending.items(): self._send_pixels(room, canvas_id, pixels)
+
+    def send_tool(self, room, canvas_id, tool, spans, color):
+        """Send a fill/shape as one `tool_applied` frame of flat [y, x0, x1, ...] spans. It goes out immediately, after
+        any pixels still buffered for the room, so clients apply both in the order the server did."""
+        pending = self._pending.pop(room, None)
+        if pending: self._send_pixels(room, *pending)
+        self._emit('tool_applied', room, canvas_id, {'t': tool, 'c': color, 's': [v for span in spans for v in span]})
+        self.stats['tools_sent'] += 1
+
+    def _send_pixels(self, room, canvas_id, pixels):
+        self._emit('pixels_placed', room, canvas_id, {'p': [v for (x, y), color in pixels.items() for v in (x, y, color)]})
+        self.stats['pixels_sent'] += len(pixels)
+        self.stats['frames_sent'] += 1
+
+    def _emit(self, event_name, room, canvas_id, frame):
+        state = canvas_store.peek(canvas_id)
+        if state: frame['e'], frame['v'] = state.epoch, state.version
+        socketio.emit(event_name, frame, room=room)
+
+    @property
+    def pending(self):
+        return sum(len(pixels) for _, pixels in self._pending.values())
+
+    @property
+    def frames_saved(self):
+        """Frames a one-event-per-pixel broadcast would have needed on top of what was actually sent."""
+        return self.stats['pixels_queued'] - self.stats['frames_sent']
+
+broadcaster = PixelBroadcaster(app.config['BROADCAST_TICK_MS'] / 1000)
+
+# --- Pub Directory Cache ---
+PubInfo = namedtuple('PubInfo', ['id', 'name', 'owner_id', 'is_private', 'canvas_id'])
+LOBBY_NAME = 'The Guest Pub'
+
+class PubDirectory:
+    """Id, name, owner, privacy and canvas of every pub, loaded with one query and reloaded after any pub changes.
+
+    invalidate() goes over the bus so every worker drops its copy, along with the chat and canvas of deleted pubs.
+    """
+    def __init__(self):
+        self._pubs = None  # pub_id -> PubInfo, in id order
+        self._by_canvas = None  # canvas_id -> PubInfo
+        self._generation = 0
+
+    def _load(self):
+        pubs = self._pubs
+        if pubs is None:
+            generation = self._generation
+            rows = db.session.query(Pub.id, Pub.name, Pub.owner_id, Pub.is_private, Pub.canvas_id).order_by(Pub.id).all()
+            pubs = {row.id: PubInfo(*row) for row in rows}
+            if generation == self._generation: self._pubs = pubs  # Don't keep a copy that was invalidated mid-query.
+        return pubs
+
+    def get(self, pub_id):
+        return self._load().get(pub_id)
+
+    def by_canvas(self, canvas_id):
+        pubs, index = self._load(), self._by_canvas
+        if index is None or pubs is not self._pubs:
+            index = {p.canvas_id: p for p in pubs.values()}
+            if pubs is self._pubs: self._by_canvas = index
+        return index.get(canvas_id)
+
+    def lobby(self):
+        return next((p for p in self._load().values() if p.name == LOBBY_NAME), None)
+
+    def community(self):
+        return [p for p in self._load().values() if p.owner_id is None and p.name != LOBBY_NAME]
+
+    def owned_memberships(self, user_id):
+        """Pubs with an owner that the user is a member of."""
+        pubs = self._load()
+        member_of = db.session.query(PubMember.pub_id).filter_by(user_id=user_id).all()
+        return sorted((pubs[row.pub_id] for row in member_of if row.pub_id in pubs and pubs[row.pub_id].owner_id is not None), key=lambda p: p.id)
+
+    def invalidate(self, deleted=()):
+        """Reload on next use everywhere. `deleted` lists the (pub_id, canvas_id) of removed pubs."""
+        # Apply here first: the bus may hand the message back asynchronously, after the redirect has read the cache.
+        message = {'deleted': [list(pair) for pair in deleted]}
+        self.clear(message)
+        evict_deleted_pubs(message)
+        canvas_bus.publish('pubs', message)
+
+    def clear(self, message=None):
+        self._pubs = self._by_canvas = None
+        self._generation += 1
+
+pub_directory = PubDirectory()
+canvas_bus.subscribe('pubs', pub_directory.clear)
+
+# --- Friends Graph Cache ---
+class FriendGraph:
+    """Each user's accepted friends and every user they have any friendship row with, cached until one changes.
+
+    A user's adjacency costs one query per side of the (user_one_id, user_two_id) pair, both served by an index.
+    """
+    def __init__(self):
+        self._adjacency = {}  # user_id -> (friend ids, related ids incl. pending)
+
+    def _load(self, user_id):
+        adjacency = self._adjacency.get(user_id)
+        if adjacency is None:
+            rows = db.session.query(Friendship.user_two_id, Friendship.status).filter(Friendship.user_one_id == user_id).all()
+            rows += db.session.query(Friendship.user_one_id, Friendship.status).filter(Friendship.user_two_id == user_id).all()
+            adjacency = ({other for other, status in rows if status == 'accepted'}, {other for other, _ in rows})
+            self._adjacency[user_id] = adjacency
+        return adjacency
+
+    def friends(self, user_id):
+        return self._load(user_id)[0]
+
+    def related(self, user_id):
+        return self._load(user_id)[1]
+
+    def invalidate(self, *user_ids):
+        # Clear here too, so the redirect after a friendship change never reads the old adjacency.
+        self.clear({'user_ids': user_ids})
+        canvas_bus.publish('friends', {'user_ids': list(user_ids)})
+
+    def clear(self, message):
+        for user_id in message['user_ids']:
+            self._adjacency.pop(user_id, None)
+
+friend_graph = FriendGraph()
+canvas_bus.subscribe('friends', friend_graph.clear)
+
+# --- Chat Ring Buffer ---
+class ChatLog:
+    """The newest CHAT_HISTORY messages of each pub in a fixed-size deque, serving page renders without touching the DB.
+
+    A pub's buffer is loaded from the DB on first use. New messages are published on the bus so every worker's buffer
+    sees them, and persisted by the write-behind flusher.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._rings = {}  # pub_id -> deque of {'user_id', 'username', 'avatar_url', 'timestamp', 'content'}
+
+    def ring(self, pub_id):
+        """The pub's buffer, loading it if needed. None if the pub does not exist."""
+        if not pub_directory.get(pub_id): return None  # Checked every time: the pub may have been deleted on another worker.
+        ring = self._rings.get(pub_id)
+        if ring is None:
+            messages = ChatMessage.query.options(joinedload(ChatMessage.user)).filter_by(pub_id=pub_id).order_by(ChatMessage.timestamp.desc()).limit(self.size).all()
+            loaded = deque((self._entry(m.user_id, m.user.username if m.user_id != 0 else 'Guest', m.user.avatar_version, m.timestamp, m.content)
+                            for m in reversed(messages)), maxlen=self.size)
+            ring = self._rings.setdefault(pub_id, loaded)
+        return ring
+
+    @staticmethod
+    def _entry(user_id, username, avatar_version, timestamp, content):
+        return {'user_id': user_id, 'username': username, 'avatar_url': avatar_url(user_id, avatar_version), 'timestamp': timestamp, 'content': content}
+
+    def publish(self, pub_id, user_id, username, avatar_version, timestamp, content):
+        canvas_bus.publish('chat', {'pub_id': pub_id, 'user_id': user_id, 'username': username, 'avatar_version': avatar_version,
+                                    'timestamp': timestamp.isoformat(), 'content': content})
+
+    def apply(self, message):
+        ring = self._rings.get(message['pub_id'])
+        if ring is not None:
+            ring.append(self._entry(message['user_id'], message['username'], message['avatar_version'],
+                                    datetime.fromisoformat(message['timestamp']), message['content']))
+
+    def evict(self, pub_id):
+        self._rings.pop(pub_id, None)
+        write_behind.discard_chat(pub_id)
+
+chat_log = ChatLog(app.config['CHAT_HISTORY'])
+canvas_bus.subscribe('chat', chat_log.apply)
+
+def evict_deleted_pubs(message):
+    """Drop the chat buffer and canvas of pubs deleted on any worker, so none keeps accepting writes for them."""
+    for pub_id, canvas_id in message.get('deleted', ()):
+        chat_log.evict(pub_id)
+        canvas_store.evict(canvas_id)
+canvas_bus.subscribe('pubs', evict_deleted_pubs)
+# Listen from startup, once every channel has its subscriber: even a worker that only serves pages must hear about
+# pub and friendship changes made elsewhere.
+canvas_bus.start()
+
+# --- Timelapse Export ---
+class TimelapseExporter:
+    """Builds a ZIP of PNG frames showing a canvas being drawn, in a background task.
+
+    Replay starts from the canvas's oldest keyframe and applies pixel history in batches, snapping back to each later
+    keyframe as it is passed (keyframes also hold guests' pixels, which history doesn't) and painting tool ops in
+    timestamp order between the pixels. Only the current frame is held
+    in memory and each PNG is written straight to a temporary ZIP, so even million-row histories stay bounded.
+    """
+    BATCH_SIZE = 2000
+
+    def __init__(self, max_frames, ttl):
+        self.max_frames, self.ttl = max_frames, ttl
+        self.jobs = {}  # job_id -> {'canvas_id', 'user_id', 'status', 'frames', 'path', 'created'}
+
+    def start(self, canvas_id, user_id):
+        self._prune()
+        for job_id, job in self.jobs.items():
+            if job['canvas_id'] == canvas_id and job['user_id'] == user_id and job['status'] == 'running': return job_id
+        job_id = secrets.token_urlsafe(8)
+        self.jobs[job_id] = {'canvas_id': canvas_id, 'user_id': user_id, 'status': 'running', 'frames': 0, 'path': None, 'created': time.monotonic()}
+        socketio.start_background_task(self._run, job_id)
+        return job_id
+
+    def _prune(self):
+        """Forget expired jobs and delete their ZIPs, along with exports left behind by an earlier process."""
+        for job_id, job in list(self.jobs.items()):
+            if job['status'] != 'running' and time.monotonic() - job['created'] > self.ttl:
+                if job['path'] and os.path.exists(job['path']): os.remove(job['path'])
+                del self.jobs[job_id]
+        # Other workers on this machine share the temp dir, so only files untouched for the whole TTL go.
+        known = {job['path'] for job in self.jobs.values()}
+        for path in glob.glob(os.path.join(tempfile.gettempdir(), 'timelapse-*.zip')):
+            try:
+                if path not in known and time.time() - os.path.getmtime(path) > self.ttl: os.remove(path)
+            except OSError: pass  # Already removed by another worker.
+
+    def start_cleanup(self):
+        """Prune now and then every quarter TTL, so finished exports expire even if no new one is started."""
+        def run():
+            while True:
+                try: self._prune()
+                except Exception: log.exception("timelapse_prune_failed")
+                socketio.sleep(max(60, self.ttl / 4))
+        socketio.start_background_task(run)
+
+    def _run(self, job_id):
+        job = self.jobs[job_id]
+        fd, job['path'] = tempfile.mkstemp(prefix='timelapse-', suffix='.zip')
+        os.close(fd)
+        try:
+            with app.app_context(), zipfile.ZipFile(job['path'], 'w', zipfile.ZIP_STORED) as archive:
+                for frame in self._frames(job['canvas_id']):
+                    archive.writestr(f"frame_{job['frames']:05d}.png", frame)  # PNGs are already compressed.
+                    job['frames'] += 1
+                    socketio.sleep(0)  # Let sockets and requests run between frames.
+            job['status'] = 'done'
+        except Exception:
+            log.exception("timelapse_failed job=%s canvas=%s", job_id, job['canvas_id'])
+            job['status'] = 'failed'
+
+    def _frames(self, canvas_id):
+        canvas = db.session.get(Canvas, canvas_id)
+        width, height = canvas.width, canvas.height
+        keyframes = db.session.query(CanvasKeyframe.id, CanvasKeyframe.timestamp).filter_by(canvas_id=canvas_id).order_by(CanvasKeyframe.timestamp).all()
+        # Start from the oldest keyframe, unless history from before it survives (the first keyframe is only written on
+        # a flush an interval after the canvas was created); then replay from a blank canvas with every keyframe on the way.
+        first_row = db.session.query(func.min(PixelHistory.timestamp)).filter_by(canvas_id=canvas_id).scalar()
+        first_op = db.session.query(func.min(CanvasOp.timestamp)).filter_by(canvas_id=canvas_id).scalar()
+        earliest = min([t for t in (first_row, first_op) if t is not None], default=None)
+        base = keyframes[0] if keyframes and (earliest is None or earliest >= keyframes[0].timestamp) else None
+        start = base.timestamp if base else datetime.min
+        rows = PixelHistory.query.filter(PixelHistory.canvas_id == canvas_id, PixelHistory.timestamp > start)
+        ops = db.session.query(CanvasOp.id, CanvasOp.timestamp).filter(CanvasOp.canvas_id == canvas_id, CanvasOp.timestamp > start).all()
+        # Keyframes after the base and tool ops, oldest first; each is applied just before the first pixel stamped after it.
+        timeline = deque(sorted([(k.timestamp, k.id, 'keyframe') for k in keyframes if k is not base] + [(op.timestamp, op.id, 'op') for op in ops]))
+        step = max(1, -(-(rows.count() + len(keyframes) + len(ops)) // self.max_frames))
+        pixels, changes = bytearray(WHITE_RGB * (width * height)), 0
+        if base: pixels = bytearray(load_pixels(db.session.get(CanvasKeyframe, base.id).pixels, None, width, height))
+        yield self._png(pixels, width, height)
+        for row in itertools.chain(self._history_rows(canvas_id, start), [None]):
+            while timeline and (row is None or timeline[0][0] <= row.timestamp):
+                _, event_id, kind = timeline.popleft()
+                if kind == 'keyframe':
+                    pixels = bytearray(load_pixels(db.session.get(CanvasKeyframe, event_id).pixels, None, width, height))
+                else:
+                    op = db.session.get(CanvasOp, event_id)
+                    rgb = bytes.fromhex(op.color[1:])
+                    for y, x0, x1 in decode_spans(op.spans):
+                        i = (y * width + x0) * 3
+                        pixels[i:i + (x1 - x0 + 1) * 3] = rgb * (x1 - x0 + 1)
+                changes += 1
+                if changes >= step:
+                    yield self._png(pixels, width, height)
+                    changes = 0
+            if row is None: break
+            rgb = parse_color(row.color)
+            if rgb and 0 <= row.x < width and 0 <= row.y < height:
+                i = (row.y * width + row.x) * 3
+                pixels[i:i + 3] = rgb
+            changes += 1
+            if changes >= step:
+                yield self._png(pixels, width, height)
+                changes = 0
+        # Finish on the live canvas, which also covers anything not yet flushed.
+        state = canvas_store.get(canvas_id)
+        yield self._png(state.pixels if state else pixels, width, height)
+
+    def _history_rows(self, canvas_id, start):
+        last_id = 0
+        while True:
+            batch = db.session.query(PixelHistory.id, PixelHistory.x, PixelHistory.y, PixelHistory.color, PixelHistory.timestamp).filter(
+                PixelHistory.canvas_id == canvas_id, PixelHistory.timestamp > start, PixelHistory.id > last_id).order_by(PixelHistory.id).limit(self.BATCH_SIZE).all()
+            if not batch: return
+            db.session.rollback()  # End the read transaction between batches so SQLite writers aren't held up.
+            yield from batch
+            last_id = batch[-1].id
+
+    @staticmethod
+    def _png(pixels, width, height):
+        # No coalescing key: frames are unique. Past the queue bound the export waits its turn rather than failing.
+        while True:
+            try: return renderer.run(None, encode_png, bytes(pixels), width, height)
+            except RenderQueueFull: socketio.sleep(0.1)
+
+timelapses = TimelapseExporter(app.config['TIMELAPSE_MAX_FRAMES'], app.config['TIMELAPSE_TTL'])
+timelapses.start_cleanup()
+
+# --- Rate Limiting ---
+class RateLimiter:
+    """Token buckets per (event, user) and per (event, room), so one client or one hot room can't starve the worker."""
+    PRUNE_EVERY = 10000
+
+    def __init__(self, budgets, policy, max_wait):
+        self.budgets, self.policy, self.max_wait = budgets, policy, max_wait
+        self._buckets = {}  # (event, scope, key) -> [tokens, last refill time]
+        self._calls = 0
+        self.stats = {event: {'allowed': 0, 'queued': 0, 'dropped': 0} for event in budgets}
+
+    def _wait_time(self, event, scope, key, cost, now):
+        """Refill a bucket and return how long until it holds `cost` tokens (0 if it already does)."""
+        rate, burst = self.budgets[event][scope]
+        bucket = self._buckets.setdefault((event, scope, key), [burst, now])
+        bucket[0], bucket[1] = min(burst, bucket[0] + (now - bucket[1]) * rate), now
+        # A single charge larger than the burst can never fit, so it is clamped to a full bucket.
+        return max(0.0, min(cost, burst) - bucket[0]) / rate
+
+    def allow(self, event, user_key, room_key, cost=1):
+        """Charge both buckets for an event, waiting first under the 'queue' policy. Returns False if it must be dropped."""
+        if event not in self.budgets: return True
+        self._calls += 1
+        if self._calls % self.PRUNE_EVERY == 0: self._prune()
+        keys = [('user', user_key), ('room', room_key)]
+        now = time.monotonic()
+        wait = max(self._wait_time(event, scope, key, cost, now) for scope, key in keys)
+        if wait > 0:
+            if self.policy != 'queue' or wait > self.max_wait:
+                self.stats[event]['dropped'] += 1
+                return False
+            self.stats[event]['queued'] += 1
+            socketio.sleep(wait)
+            now = time.monotonic()
+            for scope, key in keys: self._wait_time(event, scope, key, cost, now)
+        for scope, key in keys:
+            bucket = self._buckets[(event, scope, key)]
+            bucket[0] -= min(cost, self.budgets[event][scope][1])
+        self.stats[event]['allowed'] += 1
+        return True
+
+    def _prune(self):
+        """Forget buckets that have refilled completely; they behave exactly like new ones."""
+        now = time.monotonic()
+        for bucket_key, (tokens, updated) in list(self._buckets.items()):
+            rate, burst = self.budgets[bucket_key[0]][bucket_key[1]]
+            if tokens + (now - updated) * rate >= burst: del self._buckets[bucket_key]
+
+rate_limiter = RateLimiter(app.config['RATE_LIMITS'], app.config['RATE_LIMIT_POLICY'], app.config['RATE_LIMIT_MAX_WAIT'])
+
+# --- Metrics ---
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets, self.counts, self.sum, self.count = buckets, [0] * (len(buckets) + 1), 0.0, 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """In-process counters and histograms rendered in the Prometheus text format. Every call is a no-op when disabled."""
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+    SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._collectors = []  # callables yielding (type, name, labels, value) at scrape time
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None: histogram = self._histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def collector(self, f):
+        self._collectors.append(f)
+        return f
+
+    @staticmethod
+    def _labels(labels, **extra):
+        pairs = list(labels) + list(extra.items())
+        if not pairs: return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines, typed = [], set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+        samples = [('counter', name, labels, value) for (name, labels), value in self._counters.items()]
+        for f in self._collectors: samples.extend(f())
+        for kind, name, labels, value in sorted(samples, key=lambda sample: sample[1]):
+            declare(name, kind)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(app.config['METRICS_ENABLED'])
+
+@metrics.collector
+def collect_state():
+    """Gauges and counters read from the live objects at scrape time, so the hot paths don't pay for them."""
+    rooms = socketio.server.manager.rooms.get('/', {}) if socketio.server else {}
+    for room, members in list(rooms.items()):
+        if isinstance(room, str) and room.startswith('pub_'): yield 'gauge', 'pixelpub_room_members', (('room', room),), len(members)
+    yield 'gauge', 'pixelpub_queue_depth', (('queue', 'write_behind'),), write_behind.pending
+    yield 'gauge', 'pixelpub_queue_depth', (('queue', 'broadcast'),), broadcaster.pending
+    yield 'gauge', 'pixelpub_queue_depth', (('queue', 'render'),), renderer.waiting
+    yield 'gauge', 'pixelpub_queue_depth', (('queue', 'timelapse'),), sum(job['status'] == 'running' for job in timelapses.jobs.values())
+    yield 'gauge', 'pixelpub_canvases_loaded', (), len(canvas_store)
+    for name, value in broadcaster.stats.items():
+        yield 'counter', f'pixelpub_broadcast_{name}_total', (), value
+    yield 'counter', 'pixelpub_broadcast_frames_saved_total', (), broadcaster.frames_saved
+    for event_name, counts in rate_limiter.stats.items():
+        for outcome, value in counts.items():
+            yield 'counter', 'pixelpub_rate_limited_events_total', (('event', event_name), ('outcome', outcome)), value
+
+if metrics.enabled:
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+        metrics.observe('pixelpub_db_query_seconds', time.perf_counter() - conn.info['query_started'].pop())
+
+    @event.listens_for(Engine, 'handle_error')
+    def _drop_query_timer(context):
+        # A failed statement never reaches after_cursor_execute; drop its start time so conn.info doesn't grow.
+        started = context.connection.info.get('query_started') if context.connection is not None and context.statement is not None else None
+        if started: started.pop()
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _stop_request_timer(response):
+        endpoint = request.endpoint or 'unknown'
+        metrics.observe('pixelpub_http_request_seconds', time.perf_counter() - g.request_started, endpoint=endpoint)
+        if response.content_length is not None:
+            metrics.observe('pixelpub_http_response_bytes', response.content_length, Metrics.SIZE_BUCKETS, endpoint=endpoint)
+        return response
+
+def instrumented(event_name):
+    """Time a socket handler and record its payload size."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(data=None, *args, **kwargs):
+            if not metrics.enabled: return f(data, *args, **kwargs)
+            start = time.perf_counter()
+            try: return f(data, *args, **kwargs)
+            finally:
+                metrics.observe('pixelpub_socket_event_seconds', time.perf_counter() - start, event=event_name)
+                metrics.observe('pixelpub_socket_payload_bytes', payload_size(data), Metrics.SIZE_BUCKETS, event=event_name)
+        return decorated_function
+    return decorator
+
+PAYLOAD_ITEM_BYTES = 32  # Rough JSON size of one {"x": .., "y": .., "color": "#rrggbb"} entry.
+
+def payload_size(data):
+    """Approximate JSON size of a socket event, from its top-level values only, so big strokes aren't re-encoded."""
+    if not isinstance(data, dict): return len(str(data))
+    return sum(len(key) + (len(value) * PAYLOAD_ITEM_BYTES if isinstance(value, (list, dict)) else len(str(value))) + 6 for key, value in data.items())
 
 # --- Helper Functions ---
 def login_required(f):
@@ -108,6 +1576,39 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def rate_limited(event, cost=lambda data: 1, on_drop=None):
+    """Drop (or delay) a socket event once the sender or its room is over the event's budget. on_drop(data) runs for
+    each dropped event."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(data, *args, **kwargs):
+            if not isinstance(data, dict): return
+            identity = socket_identity()
+            user_key = (identity.user_id or identity.name) if identity else request.sid
+            # Charge the pub the event resolves to, so '1', '01' and 1 can't each get a fresh room bucket.
+            pub = pub_directory.get(as_int(data['pub_id'])) if 'pub_id' in data else pub_directory.by_canvas(as_int(data.get('canvas_id')))
+            if not rate_limiter.allow(event, user_key, str(pub.id if pub else None), cost(data)):
+                if on_drop: on_drop(data)
+                return
+            return f(data, *args, **kwargs)
+        return decorated_function
+    return decorator
+
+def restore_pixel(data):
+    """Send a dropped pixel's server colour back to its sender, whose canvas already shows the rejected one, and
+    remember it so the stroke's log_pixel_history leaves it out."""
+    pub = pub_directory.get(as_int(data.get('pub_id')))
+    state = canvas_store.peek(pub.canvas_id) if pub else None
+    x, y = as_int(data.get('x')), as_int(data.get('y'))
+    if state and x is not None and y is not None and 0 <= x < state.width and 0 <= y < state.height:
+        i = (y * state.width + x) * 3
+        emit('pixels_placed', {'p': [x, y, state.pixels[i:i + 3].hex()]})
+        request.environ.setdefault(DROPPED_PIXELS, {}).setdefault(state.id, set()).add((x, y))
+
+def pixel_count(data):
+    pixels = data.get('pixels')
+    return len(pixels) if isinstance(pixels, list) else 1
+
 def apology(message, code=400):
     """Render message as an apology to user."""
     def escape(s):
@@ -117,6 +1618,13 @@ def apology(message, code=400):
         return s
     return render_template("apology.html", top=code, bottom=escape(message)), code
 
+app.jinja_env.globals['avatar_url'] = avatar_url
+
+@app.errorhandler(RenderQueueFull)
+def render_queue_full(e):
+    body, code = apology("Too many images rendering, try again shortly", 503)
+    return body, code, {'Retry-After': '1'}
+
 # --- All HTTP Routes ---
 @app.route("/")
 def index():
@@ -126,12 +1634,9 @@ def index():
 @app.route("/dashboard")
 def dashboard():
     user_id = session.get("user_id")
-    my_pubs = []
-    if user_id:
-        my_pubs = Pub.query.join(PubMember).filter(PubMember.user_id == user_id, Pub.owner_id != None).all()
-    
-    lobby_pub = Pub.query.filter_by(name='The Guest Pub').first()
-    community_pubs = Pub.query.filter(Pub.owner_id == None, Pub.name != 'The Guest Pub').all()
+    my_pubs = pub_directory.owned_memberships(user_id) if user_id else []
+    lobby_pub = pub_directory.lobby()
+    community_pubs = pub_directory.community()
     
     return render_template("dashboard.html", my_pubs=my_pubs, lobby_pub=lobby_pub, community_pubs=community_pubs)
 
@@ -144,9 +1649,10 @@ def create_pub():
         try: width, height = int(request.form.get("width")), int(request.form.get("height"))
         except: return apology("Width and height must be valid numbers.", 400)
         if not name or len(name) > 50: return apology("Invalid pub name", 400)
-        if not (16 <= width <= 256 and 16 <= height <= 256): return apology("Width/height must be between 16 and 256.", 400)
+        max_size = app.config['MAX_CANVAS_SIZE']
+        if not (16 <= width <= max_size and 16 <= height <= max_size): return apology(f"Width/height must be between 16 and {max_size}.", 400)
         
-        new_canvas = Canvas(name=f"{name}'s Canvas", width=width, height=height, canvas_data=json.dumps([['#FFFFFF' for _ in range(width)] for _ in range(height)]))
+        new_canvas = Canvas(name=f"{name}'s Canvas", width=width, height=height, pixels=blank_pixels(width, height))
         new_pub = Pub(name=name, owner_id=user_id, is_private=is_private, canvas=new_canvas)
         db.session.add(new_pub)
         db.session.commit()
@@ -154,6 +1660,7 @@ def create_pub():
         new_member = PubMember(pub_id=new_pub.id, user_id=user_id)
         db.session.add(new_member)
         db.session.commit()
+        pub_directory.invalidate()
 
         flash("Pub created successfully!")
         return redirect(f"/pub/{new_pub.id}")
@@ -165,9 +1672,10 @@ def pub(pub_id):
     user_id, guest_name = session.get("user_id"), session.get("guest_name")
     if not user_id and not guest_name: return redirect("/login")
     
-    pub_info = Pub.query.get_or_404(pub_id)
+    pub_info = pub_directory.get(pub_id)
+    if not pub_info: return apology("Pub not found", 404)
 
-    if guest_name and pub_info.name != "The Guest Pub": return apology("Guests can only access The Guest Pub.", 403)
+    if guest_name and pub_info.name != LOBBY_NAME: return apology("Guests can only access The Guest Pub.", 403)
         
     if user_id:
         member_check = PubMember.query.filter_by(pub_id=pub_id, user_id=user_id).first()
@@ -179,23 +1687,16 @@ def pub(pub_id):
             except IntegrityError:
                 db.session.rollback()
     
-    chat_history_query = ChatMessage.query.options(joinedload(ChatMessage.user)).filter_by(pub_id=pub_id).order_by(ChatMessage.timestamp.asc()).limit(100).all()
-    chat_display_data = []
-    for message in chat_history_query:
-        chat_display_data.append({
-            'user_id': message.user_id,
-            'username': message.user.username if message.user_id != 0 else 'Guest',
-            'timestamp': message.timestamp.strftime('%H:%M'),
-            'content': message.content
-        })
+    chat_display_data = [dict(entry, timestamp=entry['timestamp'].strftime('%H:%M')) for entry in chat_log.ring(pub_id)]
 
     friends_to_invite = []
     if user_id:
-        friends_subquery = db.session.query(User.id).join(Friendship, or_(User.id == Friendship.user_one_id, User.id == Friendship.user_two_id)).filter(or_(Friendship.user_one_id == user_id, Friendship.user_two_id == user_id), Friendship.status == 'accepted', User.id != user_id)
-        members_subquery = db.session.query(PubMember.user_id).filter(PubMember.pub_id == pub_id)
-        friends_to_invite = User.query.filter(User.id.in_(friends_subquery), User.id.notin_(members_subquery)).all()
+        friend_ids = friend_graph.friends(user_id)
+        if friend_ids:
+            members_subquery = db.session.query(PubMember.user_id).filter(PubMember.pub_id == pub_id)
+            friends_to_invite = User.query.filter(User.id.in_(friend_ids), User.id.notin_(members_subquery)).all()
         
-    return render_template("pub.html", pub=pub_info, canvas=pub_info.canvas, chat=chat_display_data, friends=friends_to_invite)
+    return render_template("pub.html", pub=pub_info, canvas=canvas_store.get(pub_info.canvas_id), tile_size=TILE_SIZE, chat=chat_display_data, friends=friends_to_invite)
 
 @app.route("/invite_to_pub/<int:pub_id>", methods=["POST"])
 @login_required
@@ -223,6 +1724,7 @@ def delete_pub(pub_id):
     ChatMessage.query.filter_by(pub_id=pub_id).delete()
     db.session.delete(pub_info)
     db.session.commit()
+    pub_directory.invalidate(deleted=[(pub_id, pub_info.canvas_id)])
     flash("Pub and all its data have been permanently deleted.")
     return redirect("/dashboard")
 
@@ -235,49 +1737,102 @@ def toggle_pub_privacy(pub_id):
     
     pub_info.is_private = not pub_info.is_private
     db.session.commit()
+    pub_directory.invalidate()
     flash(f"Pub is now {'Private' if pub_info.is_private else 'Public'}.")
     return redirect(f"/pub/{pub_id}")
 
 @app.route("/canvas_preview/<int:canvas_id>.png")
 def canvas_preview(canvas_id):
-    canvas = Canvas.query.get(canvas_id)
-    if not canvas: return apology("Canvas not found", 404)
-    width, height, pixels_json = canvas.width, canvas.height, canvas.canvas_data
-    img = Image.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(img)
-    try:
-        pixels = json.loads(pixels_json)
-        for y, row in enumerate(pixels):
-            for x, color in enumerate(row):
-                if color and color != '#FFFFFF': draw.point((x, y), fill=color)
-    except: pass
+    preview = canvas_store.preview(canvas_id)
+    if not preview: return apology("Canvas not found", 404)
+    png, etag, last_modified = preview
+    response = Response(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True  # Browsers keep the image but revalidate, getting a 304 while it is unchanged.
+    return response.make_conditional(request)
+
+AVATAR_PIXEL_SIZE = 10
+AVATAR_BACKGROUND = b'\xdd\xdd\xdd'
+AVATAR_CACHE_SIZE = 2048
+avatar_pngs = OrderedDict()  # avatar version -> PNG bytes, least recently used first
+
+def render_avatar(rgb):
+    """Upscale a 32x32 avatar to a PNG with nearest-neighbour resizing; white pixels show as the grey background."""
+    rgb = rgb or WHITE_RGB * (AVATAR_SIZE * AVATAR_SIZE)
+    rgb = b''.join(AVATAR_BACKGROUND if rgb[i:i + 3] == WHITE_RGB else rgb[i:i + 3] for i in range(0, len(rgb), 3))
+    img = Image.frombytes('RGB', (AVATAR_SIZE, AVATAR_SIZE), rgb)
+    img = img.resize((AVATAR_SIZE * AVATAR_PIXEL_SIZE, AVATAR_SIZE * AVATAR_PIXEL_SIZE), Image.NEAREST)
     img_io = io.BytesIO()
     img.save(img_io, 'PNG')
-    img_io.seek(0)
-    return Response(img_io.getvalue(), mimetype='image/png')
+    return img_io.getvalue()
+
+@app.route("/canvas/<int:canvas_id>/tiles")
+def canvas_tiles(canvas_id):
+    """Tile manifest. With ?epoch=&since= from an earlier manifest, lists only the tiles changed after that version."""
+    state = canvas_store.get(canvas_id)
+    if state is None: return apology("Canvas not found", 404)
+    since = as_int(request.args.get('since')) if request.args.get('epoch') == state.epoch else None
+    return {'epoch': state.epoch, 'version': state.version, 'tile_size': TILE_SIZE, 'tiles': state.changed_tiles(since or 0)}
+
+@app.route("/canvas/<int:canvas_id>/tile/<int:tx>/<int:ty>.rgb")
+def canvas_tile(canvas_id, tx, ty):
+    """One tile as raw RGB bytes (3 per pixel, row-major, clipped at the canvas edge)."""
+    state = canvas_store.get(canvas_id)
+    rgb = state.tile_rgb(tx, ty) if state else None
+    if rgb is None: return apology("Tile not found", 404)
+    response = Response(rgb, mimetype='application/octet-stream')
+    response.headers['X-Tile-Version'] = str(state.tile_versions[ty * state.tiles_x + tx])
+    response.set_etag(hashlib.blake2b(rgb, digest_size=16).hexdigest())
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route("/canvas/<int:canvas_id>/timelapse", methods=["POST"])
+@login_required
+def start_timelapse(canvas_id):
+    pub_info = Pub.query.filter_by(canvas_id=canvas_id).first()
+    if not pub_info: return apology("Canvas not found", 404)
+    if pub_info.is_private and not PubMember.query.filter_by(pub_id=pub_info.id, user_id=session["user_id"]).first():
+        return apology("This pub is private.", 403)
+    job_id = timelapses.start(canvas_id, session["user_id"])
+    return {'job_id': job_id, 'status_url': f"/timelapse/{job_id}", 'download_url': f"/timelapse/{job_id}.zip"}, 202
+
+@app.route("/timelapse/<job_id>")
+@login_required
+def timelapse_status(job_id):
+    job = timelapses.jobs.get(job_id)
+    if not job or job['user_id'] != session["user_id"]: return apology("Export not found", 404)
+    return {'status': job['status'], 'frames': job['frames']}
+
+@app.route("/timelapse/<job_id>.zip")
+@login_required
+def timelapse_download(job_id):
+    job = timelapses.jobs.get(job_id)
+    if not job or job['user_id'] != session["user_id"] or job['status'] != 'done': return apology("Export not found", 404)
+    return send_file(job['path'], mimetype='application/zip', as_attachment=True, download_name=f"canvas-{job['canvas_id']}-timelapse.zip")
 
 @app.route("/avatar/<int:user_id>.png")
-def avatar(user_id):
+def avatar_latest(user_id):
+    # Unversioned URL kept for old links: point at the current immutable URL, and don't let the redirect be cached.
     user = User.query.get(user_id)
-    pixel_data_json = user.avatar_data if user else None
-    AVATAR_SIZE, PIXEL_SIZE = 32, 10
-    img_size = AVATAR_SIZE * PIXEL_SIZE
-    img = Image.new('RGB', (img_size, img_size), color='#dddddd')
-    draw = ImageDraw.Draw(img)
-    if pixel_data_json:
-        try:
-            pixel_data = json.loads(pixel_data_json)
-            for y, row in enumerate(pixel_data):
-                for x, color in enumerate(row):
-                    if color and color != '#FFFFFF': draw.rectangle([x*PIXEL_SIZE, y*PIXEL_SIZE, (x+1)*PIXEL_SIZE-1, (y+1)*PIXEL_SIZE-1], fill=color)
-        except: pass
-    img_io = io.BytesIO()
-    img.save(img_io, 'PNG')
-    img_io.seek(0)
-    response = Response(img_io.getvalue(), mimetype='image/png')
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    response = redirect(avatar_url(user_id, user.avatar_version if user else None))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route("/avatar/<int:user_id>/<version>.png")
+def avatar(user_id, version):
+    png = avatar_pngs.get(version)
+    if png is None:
+        user = User.query.get(user_id)
+        current = user.avatar_version if user else None
+        if version != (current or 'blank'): return avatar_latest(user_id)
+        png = renderer.run(('avatar', version), render_avatar, load_avatar_rgb(user))
+        avatar_pngs[version] = png
+        if len(avatar_pngs) > AVATAR_CACHE_SIZE: avatar_pngs.popitem(last=False)
+    else:
+        avatar_pngs.move_to_end(version)
+    response = Response(png, mimetype='image/png')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
     return response
 
 @app.route("/settings", methods=["GET", "POST"])
@@ -287,27 +1842,37 @@ def settings():
     if request.method == "POST":
         avatar_data = request.form.get("avatar_data")
         if not avatar_data: return apology("No avatar data received", 400)
-        try: json.loads(avatar_data)
-        except: return apology("Invalid avatar data format", 400)
-        user.avatar_data = avatar_data
+        try: grid = json.loads(avatar_data)
+        except ValueError: return apology("Invalid avatar data format", 400)
+        if not isinstance(grid, list): return apology("Invalid avatar data format", 400)
+        set_avatar(user, grid_to_rgb(grid, AVATAR_SIZE, AVATAR_SIZE))
         db.session.commit()
+        session["avatar_version"] = user.avatar_version
         flash("Avatar updated successfully!")
         return redirect("/settings")
     else:
-        current_avatar_data = user.avatar_data or 'null'
+        rgb = load_avatar_rgb(user)
+        current_avatar_data = json.dumps(rgb_to_grid(rgb, AVATAR_SIZE)) if rgb else 'null'
         return render_template("settings.html", current_avatar_data=current_avatar_data)
 
 @app.route("/friends")
 @login_required
 def friends():
     user_id = session["user_id"]
-    friends_list = User.query.join(Friendship, or_(User.id == Friendship.user_one_id, User.id == Friendship.user_two_id)).filter(or_(Friendship.user_one_id == user_id, Friendship.user_two_id == user_id), Friendship.status == 'accepted', User.id != user_id).all()
+    friend_ids = friend_graph.friends(user_id)
+    friends_list = User.query.filter(User.id.in_(friend_ids)).order_by(User.username).all() if friend_ids else []
     pending_received_query = db.session.query(Friendship, User).join(User, Friendship.action_user_id == User.id).filter(or_(Friendship.user_one_id == user_id, Friendship.user_two_id == user_id), Friendship.status == 'pending', Friendship.action_user_id != user_id).all()
-    
-    existing_relations = db.session.query(Friendship.user_one_id).filter(Friendship.user_two_id == user_id).union(db.session.query(Friendship.user_two_id).filter(Friendship.user_one_id == user_id))
-    other_users = User.query.filter(User.id != user_id, User.id != 0, User.id.notin_(existing_relations)).all()
 
-    return render_template("friends.html", friends=friends_list, pending_received=pending_received_query, other_users=other_users)
+    # Paginated, searchable directory of users with no friendship row yet, instead of listing everyone.
+    search, page = request.args.get("q", "").strip(), max(1, as_int(request.args.get("page")) or 1)
+    page_size = app.config['USER_DIRECTORY_PAGE_SIZE']
+    directory = User.query.filter(User.id != user_id, User.id != 0, User.id.notin_(friend_graph.related(user_id)))
+    if search: directory = directory.filter(User.username.ilike(f"%{search}%"))
+    other_users = directory.order_by(User.username).offset((page - 1) * page_size).limit(page_size + 1).all()
+    has_next = len(other_users) > page_size
+
+    return render_template("friends.html", friends=friends_list, pending_received=pending_received_query, other_users=other_users[:page_size],
+                           search=search, page=page, has_next=has_next)
 
 @app.route("/send_request/<int:recipient_id>", methods=["POST"])
 @login_required
@@ -321,6 +1886,7 @@ def send_request(recipient_id):
     new_request = Friendship(user_one_id=user_one, user_two_id=user_two, status='pending', action_user_id=sender_id)
     db.session.add(new_request)
     db.session.commit()
+    friend_graph.invalidate(user_one, user_two)
     flash("Friend request sent!")
     return redirect("/friends")
 
@@ -332,6 +1898,7 @@ def accept_request(friendship_id):
     if not friendship: return apology("Invalid request", 403)
     friendship.status = 'accepted'
     db.session.commit()
+    friend_graph.invalidate(friendship.user_one_id, friendship.user_two_id)
     flash("Friend request accepted!")
     return redirect("/friends")
 
@@ -343,6 +1910,7 @@ def decline_request(friendship_id):
     if not friendship: return apology("Invalid request", 403)
     db.session.delete(friendship)
     db.session.commit()
+    friend_graph.invalidate(friendship.user_one_id, friendship.user_two_id)
     flash("Friend request declined.")
     return redirect("/friends")
 
@@ -356,6 +1924,7 @@ def unfriend(friend_id):
     if friendship:
         db.session.delete(friendship)
         db.session.commit()
+        friend_graph.invalidate(user_one, user_two)
         flash("Friend removed.")
     return redirect("/friends")
 
@@ -375,8 +1944,10 @@ def admin_delete_user(user_id):
     user = User.query.get(user_id)
     if user:
         # Cascade delete should handle pubs, members, etc.
+        owned = db.session.query(Pub.id, Pub.canvas_id).filter_by(owner_id=user_id).all()
         db.session.delete(user)
         db.session.commit()
+        pub_directory.invalidate(deleted=owned)
         flash("User and all their data have been deleted.")
     return redirect("/admin")
 
@@ -389,6 +1960,7 @@ def admin_delete_pub(pub_id):
         ChatMessage.query.filter_by(pub_id=pub_id).delete()
         db.session.delete(pub)
         db.session.commit()
+        pub_directory.invalidate(deleted=[(pub_id, pub.canvas_id)])
         flash("Pub deleted by admin.")
     return redirect("/admin")
 
@@ -404,6 +1976,14 @@ def toggle_admin(user_id):
     flash(f"User role updated to {user.role}.")
     return redirect("/admin")
 
+@app.route("/metrics")
+def metrics_endpoint():
+    token = app.config['METRICS_TOKEN']
+    if not (token and secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")) and session.get("role") != "admin":
+        return apology("Admin access required", 403)
+    if not metrics.enabled: return apology("Metrics are disabled", 404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # --- Authentication Routes ---
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -415,6 +1995,7 @@ def login():
         if not user or not check_password_hash(user.hash, password):
             return apology("invalid username and/or password", 403)
         session["user_id"], session["username"], session["role"] = user.id, user.username, user.role
+        session["avatar_version"] = user.avatar_version
         flash("Logged in successfully!")
         return redirect("/")
     return render_template("login.html")
@@ -427,11 +2008,13 @@ def register():
         if password != confirmation: return apology("passwords do not match", 400)
         if User.query.filter_by(username=username).first(): return apology("username already exists", 400)
         
-        new_user = User(username=username, hash=generate_password_hash(password), avatar_data=json.dumps([['#FFFFFF' for _ in range(32)] for _ in range(32)]))
+        new_user = User(username=username, hash=generate_password_hash(password))
+        set_avatar(new_user, WHITE_RGB * (AVATAR_SIZE * AVATAR_SIZE))
         db.session.add(new_user)
         db.session.commit()
         
         session["user_id"], session["username"], session["role"] = new_user.id, new_user.username, new_user.role
+        session["avatar_version"] = new_user.avatar_version
         flash("Registered successfully!")
         return redirect("/")
     return render_template("register.html")
@@ -446,79 +2029,128 @@ def logout():
 def guest_login():
     session.clear()
     session["guest_name"] = f"Guest{random.randint(1000, 9999)}"
-    lobby = Pub.query.filter_by(name='The Guest Pub').first()
+    lobby = pub_directory.lobby()
     if lobby:
         return redirect(f"/pub/{lobby.id}")
     return apology("Main community hub not found.", 500)
 
 # --- SocketIO Handlers ---
+# Who is on a connection is resolved once, at connect, and kept in its WSGI environ, which lives as long as the
+# connection. Logging in or out and saving an avatar all reload the pub page, so the copy never goes stale.
+Identity = namedtuple('Identity', ['user_id', 'name', 'avatar_version'])  # user_id is None for guests
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    name = session.get('username') or session.get('guest_name')
+    request.environ[SOCKET_IDENTITY] = Identity(session.get('user_id'), name, session.get('avatar_version')) if name else None
+
+def socket_identity():
+    """The identity cached at connect time, or None for a connection that is neither logged in nor a guest."""
+    return request.environ.get(SOCKET_IDENTITY)
+
 @socketio.on('join_pub')
+@instrumented('join_pub')
 def handle_join_pub(data):
-    if 'user_id' not in session and 'guest_name' not in session: return
+    if not socket_identity(): return
     join_room(f"pub_{data['pub_id']}")
+    # Clients send the canvas epoch/version they last saw; reply with just the deltas they missed when we still have them.
+    pub, canvas_id = pub_directory.get(as_int(data.get('pub_id'))), as_int(data.get('canvas_id'))
+    state = canvas_store.get(canvas_id) if pub and pub.canvas_id == canvas_id else None
+    if state: emit('canvas_resync', state.resync(data.get('epoch'), as_int(data.get('version'))))
 
 @socketio.on('place_pixel')
+@instrumented('place_pixel')
+@rate_limited('place_pixel', on_drop=restore_pixel)
 def handle_place_pixel(data):
-    if 'user_id' not in session and 'guest_name' not in session: return
-    emit('pixel_placed', data, room=f"pub_{data.get('pub_id')}", include_self=False)
+    if not socket_identity(): return
+    # The pub directory and the in-memory canvas are both cached, so rejecting bad input never touches the DB.
+    pub = pub_directory.get(as_int(data.get('pub_id')))
+    state = canvas_store.get(pub.canvas_id) if pub and pub.canvas_id == as_int(data.get('canvas_id')) else None
+    pixels = validate_pixels([data], state.width, state.height, 1) if state else None
+    if not pixels: return
+    x, y, rgb = pixels[0]
+    if DROPPED_PIXELS in request.environ: request.environ[DROPPED_PIXELS].get(state.id, set()).discard((x, y))
+    canvas_store.publish_pixel(f"pub_{pub.id}", state.id, x, y, rgb)
+    write_behind.start()
 
 @socketio.on('save_canvas_state')
+@instrumented('save_canvas_state')
+@rate_limited('save_canvas_state')
 def handle_save_canvas_state(data):
-    if 'user_id' not in session and 'guest_name' not in session: return
-    canvas_id, canvas_data = data.get('canvas_id'), data.get('canvas_data')
-    if not canvas_id or not canvas_data: return
-    canvas = Canvas.query.get(canvas_id)
-    if canvas:
-        canvas.canvas_data = json.dumps(canvas_data)
-        db.session.commit()
-        print(f"Canvas {canvas.id} saved.")
+    # The client only signals the end of a stroke; the write-behind flusher persists the server's copy on its next tick.
+    if not socket_identity(): return
+    write_behind.start()
     
 @socketio.on('log_pixel_history')
+@instrumented('log_pixel_history')
+@rate_limited('log_pixel_history', cost=pixel_count)
 def handle_log_pixel_history(data):
-    user_id = session.get('user_id')
+    identity = socket_identity()
+    user_id = identity and identity.user_id
     if not user_id: return
-    canvas_id, pixels = data.get('canvas_id'), data.get('pixels')
-    if not canvas_id or not pixels: return
-    for pixel in pixels:
-        history_entry = PixelHistory(canvas_id=canvas_id, x=pixel['x'], y=pixel['y'], modifier_id=user_id, color=pixel['color'])
-        db.session.add(history_entry)
-    db.session.commit()
-    print(f"Logged {len(pixels)} pixels to history for canvas {canvas_id} by user {user_id}")
+    canvas_id, pixels = as_int(data.get('canvas_id')), data.get('pixels')
+    if not pixels or not isinstance(pixels, list) or not pub_directory.by_canvas(canvas_id): return
+    state = canvas_store.get(canvas_id)
+    if state is None: return
+    now, dropped = datetime.utcnow(), request.environ.pop(DROPPED_PIXELS, {}).get(canvas_id, ())
+    # Pixels the rate limiter dropped from this stroke never reached the canvas, so they aren't history either.
+    rows = [{'canvas_id': canvas_id, 'x': x, 'y': y, 'modifier_id': user_id, 'color': '#' + rgb.hex(), 'timestamp': now}
+            for x, y, rgb in validate_pixels(pixels, state.width, state.height, app.config['HISTORY_MAX_PIXELS']) if (x, y) not in dropped]
+    if rows: write_behind.queue_history(canvas_id, rows)
+
+@socketio.on('apply_tool')
+@instrumented('apply_tool')
+@rate_limited('apply_tool')
+def handle_apply_tool(data):
+    # Fills and shapes are computed on the server's canvas, then broadcast as one frame and logged as one CanvasOp row.
+    identity = socket_identity()
+    user_id = identity and identity.user_id
+    if not user_id: return
+    pub, tool, points = pub_directory.get(as_int(data.get('pub_id'))), data.get('tool'), data.get('points')
+    state = canvas_store.get(pub.canvas_id) if pub and pub.canvas_id == as_int(data.get('canvas_id')) else None
+    if state is None or tool not in TOOL_POINTS or not isinstance(points, list) or len(points) != TOOL_POINTS[tool]: return
+    pixels = validate_pixels([dict(p, color=data.get('color')) for p in points if isinstance(p, dict)], state.width, state.height, len(points))
+    if len(pixels) != len(points): return
+    canvas_store.publish_tool(f"pub_{pub.id}", state.id, tool, [v for x, y, _ in pixels for v in (x, y)], pixels[0][2], user_id)
+    write_behind.start()
 
 @socketio.on('request_history')
+@instrumented('request_history')
+@rate_limited('request_history')
 def handle_request_history(data):
-    canvas_id, x, y = data.get('canvas_id'), data.get('x'), data.get('y')
-    history_entry = PixelHistory.query.filter_by(canvas_id=canvas_id, x=x, y=y).order_by(PixelHistory.timestamp.desc()).first()
+    canvas_id, x, y = as_int(data.get('canvas_id')), as_int(data.get('x')), as_int(data.get('y'))
+    history_entry = db.session.query(User.username, PixelLastModifier.timestamp).join(User, User.id == PixelLastModifier.modifier_id).filter(
+        PixelLastModifier.canvas_id == canvas_id, PixelLastModifier.x == x, PixelLastModifier.y == y).first()
     if history_entry:
-        emit('history_response', {'username': history_entry.user.username, 'timestamp': history_entry.timestamp.isoformat()})
+        emit('history_response', {'username': history_entry.username, 'timestamp': history_entry.timestamp.isoformat()})
     else:
         emit('history_response', {'username': 'N/A', 'timestamp': 'Never modified'})
 
 @socketio.on('send_message')
+@instrumented('send_message')
+@rate_limited('send_message')
 def handle_send_message(data):
-    user_id = session.get('user_id')
-    username = session.get('username') or session.get('guest_name')
-    if not username: return
-    pub_id, content = data.get('pub_id'), data.get('content', '').strip()
+    identity = socket_identity()
+    if not identity: return
+    user_id, username = identity.user_id, identity.name
+    pub_id, content = as_int(data.get('pub_id')), str(data.get('content', '')).strip()
     if not (1 <= len(content) <= 250): return
+    if chat_log.ring(pub_id) is None: return
     
     user_id_for_db = user_id if user_id is not None else 0
-    new_message = ChatMessage(pub_id=pub_id, user_id=user_id_for_db, content=content)
-    db.session.add(new_message)
-    
-    message_count = ChatMessage.query.filter_by(pub_id=pub_id).count()
-    if message_count > 100:
-        oldest_message = ChatMessage.query.filter_by(pub_id=pub_id).order_by(ChatMessage.timestamp.asc()).first()
-        db.session.delete(oldest_message)
-    
-    db.session.commit()
-    message_data = {'username': username, 'avatar_id': user_id_for_db, 'content': content}
+    avatar_version, now = identity.avatar_version, datetime.utcnow()
+    write_behind.queue_chat({'pub_id': pub_id, 'user_id': user_id_for_db, 'content': content, 'timestamp': now})
+    chat_log.publish(pub_id, user_id_for_db, username if user_id is not None else 'Guest', avatar_version, now, content)
+    message_data = {'username': username, 'avatar_id': user_id_for_db, 'avatar_url': avatar_url(user_id_for_db, avatar_version), 'content': content}
     emit('new_message', message_data, room=f"pub_{pub_id}")
 
 # This block should be at the very end of the file
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        create_missing_indexes()
+        migrate_pixel_storage()
+        migrate_pixel_history()
         # Initialization logic for community pubs
         if not User.query.get(0):
             guest = User(id=0, username='__GUEST__', hash='', role='guest')
@@ -527,7 +2159,7 @@ if __name__ == '__main__':
         community_pubs_data = [("The Guest Pub", 128, 128), ("The 8-Bit Bar", 48, 48), ("The Doodle Den", 64, 32), ("The Canvas Corner", 128, 128)]
         for name, width, height in community_pubs_data:
             if not Pub.query.filter_by(name=name, owner_id=None).first():
-                canvas = Canvas(name=f"Community: {name}", width=width, height=height, canvas_data=json.dumps([['#FFFFFF' for _ in range(width)] for _ in range(height)]))
+                canvas = Canvas(name=f"Community: {name}", width=width, height=height, pixels=blank_pixels(width, height))
                 pub = Pub(name=name, is_private=False, canvas=canvas)
                 db.session.add(pub)
         
@@ -0,0 +1,55 @@
+# benchmarks/bench_pixel_history.py
+# Compares the old one-ORM-object-per-pixel history logging with bulk_insert_history() for large strokes.
+# Usage: python benchmarks/bench_pixel_history.py [strokes] [pixels_per_stroke]
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Point the app at a throwaway SQLite file before it is imported (unless DATABASE_URL is already set).
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db, User, Canvas, PixelHistory, blank_pixels, bulk_insert_history
+
+STROKES = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+PIXELS = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+def make_stroke(canvas_id, user_id):
+    now = datetime.utcnow()
+    return [{'canvas_id': canvas_id, 'x': i % 128, 'y': (i // 128) % 128, 'modifier_id': user_id, 'color': '#ff0000', 'timestamp': now}
+            for i in range(PIXELS)]
+
+def orm_path(rows):
+    for row in rows:
+        db.session.add(PixelHistory(**row))
+    db.session.commit()
+
+def bulk_path(rows):
+    bulk_insert_history(rows)
+    db.session.commit()
+
+def run(label, insert, canvas_id, user_id):
+    PixelHistory.query.delete()
+    db.session.commit()
+    start = time.perf_counter()
+    for _ in range(STROKES):
+        insert(make_stroke(canvas_id, user_id))
+    elapsed = time.perf_counter() - start
+    total = STROKES * PIXELS
+    print(f"{label:>5}: {total} rows in {elapsed:.2f}s = {total / elapsed:,.0f} rows/sec")
+
+with app.app_context():
+    db.create_all()
+    user = User(username=f'bench{os.getpid()}', hash='')
+    canvas = Canvas(name='bench', width=128, height=128, pixels=blank_pixels(128, 128))
+    db.session.add_all([user, canvas])
+    db.session.commit()
+    print(f"{STROKES} strokes x {PIXELS} pixels on {db.engine.dialect.name}")
+    run('orm', orm_path, canvas.id, user.id)
+    run('bulk', bulk_path, canvas.id, user.id)
+    PixelHistory.query.filter_by(canvas_id=canvas.id).delete()
+    db.session.delete(canvas)
+    db.session.delete(user)
+    db.session.commit()
@@ -0,0 +1,184 @@
+# benchmarks/load_test.py
+# Starts the app on a throwaway SQLite database and drives it with simulated users who draw and chat through real
+# Socket.IO connections, then reports broadcast latency, event throughput and the server's DB commit rate.
+#
+# Needs the Socket.IO client extras on top of requirements.txt:  pip install "python-socketio[client]"
+# Usage: python benchmarks/load_test.py [--pubs 2] [--users 10] [--duration 10] [--pixel-rate 20] [--stroke 10] [--chat-every 3]
+# Server settings such as RATE_LIMITS or BROADCAST_TICK_MS are read from the environment as usual.
+import argparse
+import itertools
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOAD_PUB_SIZE = 64
+
+def serve(port, pubs):
+    """Server side: bootstrap the database, add a stats route and run the app. Runs in its own process."""
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import event
+    import app as pixelpub
+    from app import app, db, socketio, User, Pub, Canvas, blank_pixels
+
+    commits = {'count': 0}
+    with app.app_context():
+        db.create_all()
+        event.listen(db.engine, 'commit', lambda conn: commits.__setitem__('count', commits['count'] + 1))
+        db.session.add(User(id=0, username='__GUEST__', hash='', role='guest'))
+        for i in range(pubs):
+            canvas = Canvas(name=f"Load {i}", width=LOAD_PUB_SIZE, height=LOAD_PUB_SIZE, pixels=blank_pixels(LOAD_PUB_SIZE, LOAD_PUB_SIZE))
+            db.session.add(Pub(name=f"Load Pub {i}", is_private=False, canvas=canvas))
+        db.session.commit()
+
+    @app.route("/__loadtest_stats")
+    def loadtest_stats():
+        pub_list = [{'id': p.id, 'canvas_id': p.canvas_id} for p in Pub.query.order_by(Pub.id).all()]
+        return {'commits': commits['count'], 'pubs': pub_list,
+                'broadcast': pixelpub.broadcaster.stats, 'rate_limits': pixelpub.rate_limiter.stats}
+
+    socketio.run(app, host='127.0.0.1', port=port, log_output=False)
+
+class Results:
+    """Counters and latency samples shared by every simulated user thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {'place_pixel': 0, 'log_pixel_history': 0, 'save_canvas_state': 0, 'send_message': 0}
+        self.received_frames = 0
+        self.pixel_sent_at = {}  # (pub_id, x, y, 'rrggbb') -> send time; colours are unique per placement
+        self.chat_sent_at = {}  # message content -> send time
+        self.pixel_latency, self.chat_latency = [], []
+        self.errors = []
+
+    def count(self, event):
+        with self.lock: self.sent[event] += 1
+
+def simulate_user(base, pub, index, args, results, deadline, colours):
+    """One registered user: draw strokes pixel by pixel, log and save each stroke, and chat now and then."""
+    import requests
+    import socketio
+
+    http = requests.Session()
+    username = f"load{os.getpid()}_{index}"
+    http.post(f"{base}/register", data={'username': username, 'password': 'load', 'confirmation': 'load'})
+    http.get(f"{base}/pub/{pub['id']}")  # Joins the pub as a member.
+
+    sio = socketio.Client(http_session=http, reconnection=False)
+
+    @sio.on('pixels_placed')
+    def on_pixels(data):
+        now, p = time.perf_counter(), data['p']
+        with results.lock:
+            results.received_frames += 1
+            for i in range(0, len(p), 3):
+                sent = results.pixel_sent_at.get((pub['id'], p[i], p[i + 1], p[i + 2]))
+                if sent is not None: results.pixel_latency.append(now - sent)
+
+    @sio.on('new_message')
+    def on_message(data):
+        sent = results.chat_sent_at.get(data['content'])
+        if sent is not None:
+            with results.lock: results.chat_latency.append(time.perf_counter() - sent)
+
+    try:
+        sio.connect(base, transports=['websocket'])
+        sio.emit('join_pub', {'pub_id': pub['id'], 'canvas_id': pub['canvas_id']})
+        stroke, next_chat = [], time.perf_counter() + random.uniform(0, args.chat_every)
+        interval = 1 / args.pixel_rate
+        while time.perf_counter() < deadline:
+            colour = f"{next(colours) & 0xffffff:06x}"
+            x, y = random.randrange(LOAD_PUB_SIZE), random.randrange(LOAD_PUB_SIZE)
+            results.pixel_sent_at[(pub['id'], x, y, colour)] = time.perf_counter()
+            sio.emit('place_pixel', {'pub_id': pub['id'], 'canvas_id': pub['canvas_id'], 'x': x, 'y': y, 'color': '#' + colour})
+            results.count('place_pixel')
+            stroke.append({'x': x, 'y': y, 'color': '#' + colour})
+            if len(stroke) >= args.stroke:
+                sio.emit('log_pixel_history', {'canvas_id': pub['canvas_id'], 'pixels': stroke})
+                sio.emit('save_canvas_state', {'canvas_id': pub['canvas_id']})
+                results.count('log_pixel_history')
+                results.count('save_canvas_state')
+                stroke = []
+            if time.perf_counter() >= next_chat:
+                content = f"{username} says {next(colours)}"
+                results.chat_sent_at[content] = time.perf_counter()
+                sio.emit('send_message', {'pub_id': pub['id'], 'content': content})
+                results.count('send_message')
+                next_chat += args.chat_every
+            time.sleep(interval)
+        time.sleep(1)  # Let the last broadcasts arrive.
+    except Exception as e:
+        with results.lock: results.errors.append(f"user {index}: {e}")
+    finally:
+        sio.disconnect()
+
+def percentile(samples, q):
+    if not samples: return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def wait_for_server(base, timeout=30):
+    import requests
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base}/__loadtest_stats").ok: return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+def run(args):
+    import requests
+
+    workdir = tempfile.mkdtemp(prefix='pixelpub-load-')
+    env = dict(os.environ, DATABASE_URL=os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'load.db')))
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--port', str(args.port), '--pubs', str(args.pubs)],
+                              cwd=workdir, env=env)
+    base = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_for_server(base)
+        before = requests.get(f"{base}/__loadtest_stats").json()
+        results, colours = Results(), itertools.count(1)
+        start = time.perf_counter()
+        deadline = start + args.duration
+        threads = [threading.Thread(target=simulate_user, args=(base, before['pubs'][i % args.pubs], i, args, results, deadline, colours))
+                   for i in range(args.pubs * args.users)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        elapsed = time.perf_counter() - start
+        after = requests.get(f"{base}/__loadtest_stats").json()
+    finally:
+        server.terminate()
+        server.wait()
+
+    total_sent = sum(results.sent.values())
+    print(f"{args.pubs} pubs x {args.users} users for {elapsed:.1f}s")
+    for event, count in results.sent.items():
+        print(f"  {event:>18}: {count} sent ({count / elapsed:,.0f}/sec)")
+    print(f"  {'all events':>18}: {total_sent / elapsed:,.0f}/sec, {results.received_frames} pixel frames received")
+    print(f"  pixel broadcast latency: p50 {percentile(results.pixel_latency, 0.5) * 1000:.1f} ms, p99 {percentile(results.pixel_latency, 0.99) * 1000:.1f} ms ({len(results.pixel_latency)} samples)")
+    print(f"  chat broadcast latency:  p50 {percentile(results.chat_latency, 0.5) * 1000:.1f} ms, p99 {percentile(results.chat_latency, 0.99) * 1000:.1f} ms ({len(results.chat_latency)} samples)")
+    commits = after['commits'] - before['commits']
+    print(f"  DB commits: {commits} ({commits / elapsed:.1f}/sec)")
+    print(f"  broadcaster: {after['broadcast']}")
+    dropped = {event: counts['dropped'] for event, counts in after['rate_limits'].items() if counts['dropped']}
+    print(f"  rate-limited drops: {dropped or 'none'}")
+    for error in results.errors[:10]: print(f"  error: {error}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Socket.IO load test for PixelPub")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--pubs', type=int, default=2)
+    parser.add_argument('--users', type=int, default=10, help="simulated users per pub")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of drawing and chatting")
+    parser.add_argument('--pixel-rate', type=float, default=20, help="pixels placed per second by each user")
+    parser.add_argument('--stroke', type=int, default=10, help="pixels per stroke before logging history and saving")
+    parser.add_argument('--chat-every', type=float, default=3, help="seconds between each user's chat messages")
+    args = parser.parse_args()
+    if args.serve: serve(args.port, args.pubs)
+    else: run(args)
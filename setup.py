@@ -1,6 +1,5 @@
 # setup.py
-import json
-from app import app, db, User, Pub, Canvas
+from app import app, db, User, Pub, Canvas, blank_pixels, migrate_pixel_storage, migrate_pixel_history, create_missing_indexes
 
 print("STARTING DATABASE SETUP...")
 
@@ -10,6 +9,18 @@ with app.app_context():
     db.create_all()
     print("Tables created (if they didn't exist).")
 
+    # Convert any canvases/avatars still stored as JSON grids to the binary pixel format
+    migrated = migrate_pixel_storage()
+    print(f"Migrated {migrated} rows to binary pixel storage.")
+
+    # create_all() doesn't add indexes to tables that already existed
+    create_missing_indexes()
+    print("Indexes created (if they didn't exist).")
+
+    # Build the per-pixel "last modified by" table from the pixel history
+    backfilled = migrate_pixel_history()
+    print(f"Backfilled {backfilled} pixels into the last-modifier table.")
+
     # Initialization logic for the special guest user
     if not User.query.get(0):
         guest = User(id=0, username='__GUEST__', hash='', role='guest')
@@ -21,7 +32,7 @@ with app.app_context():
     for name, width, height in community_pubs_data:
         if not Pub.query.filter_by(name=name, owner_id=None).first():
             print(f"Creating community pub: {name}...")
-            canvas = Canvas(name=f"Community: {name}", width=width, height=height, canvas_data=json.dumps([['#FFFFFF' for _ in range(width)] for _ in range(height)]))
+            canvas = Canvas(name=f"Community: {name}", width=width, height=height, pixels=blank_pixels(width, height))
             # We must add and commit the canvas first to get its ID
             db.session.add(canvas)
             db.session.commit()
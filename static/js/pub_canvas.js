@@ -10,6 +10,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const brushSlider = document.getElementById('brush-slider');
     const brushSizeDisplay = document.getElementById('brush-size-display');
     const downloadBtn = document.getElementById('download-btn');
+    const timelapseBtn = document.getElementById('timelapse-btn');
+    const toolSelect = document.getElementById('tool-select');
     const chatMessages = document.getElementById('chat-messages');
     const chatForm = document.getElementById('chat-form');
     const chatInput = document.getElementById('chat-input');
@@ -20,9 +22,14 @@ document.addEventListener('DOMContentLoaded', () => {
     const CANVAS_ID = canvas.dataset.canvasId;
     const GRID_WIDTH = parseInt(canvas.dataset.canvasWidth, 10);
     const GRID_HEIGHT = parseInt(canvas.dataset.canvasHeight, 10);
+    const TILE_SIZE = parseInt(canvas.dataset.tileSize, 10);
+    const TILES_X = Math.ceil(GRID_WIDTH / TILE_SIZE);
+    const TILES_Y = Math.ceil(GRID_HEIGHT / TILE_SIZE);
+    const canvasWrapper = document.getElementById('canvas-wrapper');
     
     const GRID_COLOR = "#DDDDDD";
-    let canvasData = JSON.parse(canvas.dataset.canvasData);
+    // The grid starts white and is filled in tile by tile from /canvas/<id>/tile/<tx>/<ty>.rgb.
+    let canvasData = Array.from({ length: GRID_HEIGHT }, () => Array(GRID_WIDTH).fill('#ffffff'));
 
     // --- State Management ---
     let zoomLevel = 15;
@@ -31,14 +38,41 @@ document.addEventListener('DOMContentLoaded', () => {
     const MAX_ZOOM = 40;
     let selectedColor = colorPicker.value;
     let isDrawing = false;
+    let tool = 'brush';         // 'brush' draws locally; 'line', 'rect' and 'fill' are applied by the server.
+    let shapeStart = null;      // First corner/end of the line or rectangle being dragged out
     let lastHoveredPixel = { x: -1, y: -1 };
     let pixelsToLog = [];
+    let canvasEpoch = null;     // Tile versions from the server are only comparable within one epoch.
+    let canvasVersion = 0;
+    const staleTiles = new Set(); // "tx,ty" keys of tiles that still need fetching
+    const loadingTiles = new Map(); // "tx,ty" -> [x, y, '#rrggbb', ...] changes received while that tile is in flight
+    let redrawPending = false;
 
     // --- WebSocket Handlers ---
-    socket.on('connect', () => socket.emit('join_pub', { pub_id: PUB_ID }));
-    socket.on('pixel_placed', (data) => {
-        canvasData[data.y][data.x] = data.color;
-        redrawCanvas();
+    socket.on('connect', () => {
+        socket.emit('join_pub', { pub_id: PUB_ID, canvas_id: CANVAS_ID, epoch: canvasEpoch, version: canvasVersion });
+    });
+    socket.on('canvas_resync', (data) => {
+        // Either the deltas missed while disconnected, or 'full' when the server can't bridge the gap.
+        if (data.full) {
+            syncTiles();
+            return;
+        }
+        applyPixels(data.p);
+        canvasVersion = data.version;
+    });
+    socket.on('pixels_placed', (data) => {
+        applyPixels(data.p);
+        if (data.e === canvasEpoch) canvasVersion = Math.max(canvasVersion, data.v);
+    });
+    socket.on('tool_applied', (data) => {
+        // A server-side fill or shape as flat [y, x0, x1, ...] spans in one colour.
+        const color = '#' + data.c;
+        for (let i = 0; i < data.s.length; i += 3) {
+            for (let x = data.s[i + 1]; x <= data.s[i + 2]; x++) setPixel(x, data.s[i], color);
+        }
+        scheduleRedraw();
+        if (data.e === canvasEpoch) canvasVersion = Math.max(canvasVersion, data.v);
     });
     socket.on('new_message', (data) => appendMessage(data));
     socket.on('history_response', (data) => {
@@ -52,16 +86,103 @@ document.addEventListener('DOMContentLoaded', () => {
     function appendMessage(data) {
         const messageEl = document.createElement('div');
         messageEl.classList.add('chat-message', 'mb-2');
-        messageEl.innerHTML = `<img src="/avatar/${data.avatar_id}.png" class="avatar-sm me-2"><div><strong class="me-2">${data.username}</strong><small class="text-muted">${new Date().toLocaleTimeString([],{hour:'2-digit',minute:'2-digit'})}</small><p class="mb-0">${data.content}</p></div>`;
+        messageEl.innerHTML = `<img src="${data.avatar_url}" class="avatar-sm me-2"><div><strong class="me-2">${data.username}</strong><small class="text-muted">${new Date().toLocaleTimeString([],{hour:'2-digit',minute:'2-digit'})}</small><p class="mb-0">${data.content}</p></div>`;
         chatMessages.appendChild(messageEl);
         chatMessages.scrollTop = chatMessages.scrollHeight;
     }
 
+    function applyPixels(p) {
+        // A flat [x, y, 'rrggbb', ...] list in placement order.
+        for (let i = 0; i < p.length; i += 3) setPixel(p[i], p[i + 1], '#' + p[i + 2]);
+        scheduleRedraw();
+    }
+
+    function setPixel(x, y, color) {
+        canvasData[y][x] = color;
+        // The tile response may predate this change, so it is replayed once the tile's bytes have been written.
+        const pending = loadingTiles.get(`${Math.floor(x / TILE_SIZE)},${Math.floor(y / TILE_SIZE)}`);
+        if (pending) pending.push(x, y, color);
+    }
+
+    // --- Tile Loading ---
+    async function syncTiles() {
+        // On first load every tile is listed; after a reconnect only the tiles changed since our last version are.
+        const params = canvasEpoch ? `?epoch=${canvasEpoch}&since=${canvasVersion}` : '';
+        const response = await fetch(`/canvas/${CANVAS_ID}/tiles${params}`);
+        if (!response.ok) return;
+        const manifest = await response.json();
+        canvasEpoch = manifest.epoch;
+        canvasVersion = manifest.version;
+        manifest.tiles.forEach(([tx, ty]) => staleTiles.add(`${tx},${ty}`));
+        loadVisibleTiles();
+    }
+
+    function visibleTileRange() {
+        const canvasRect = canvas.getBoundingClientRect();
+        const viewRect = canvasWrapper.getBoundingClientRect();
+        const left = Math.max(viewRect.left, canvasRect.left) - canvasRect.left;
+        const top = Math.max(viewRect.top, canvasRect.top) - canvasRect.top;
+        const right = Math.min(viewRect.right, canvasRect.right) - canvasRect.left;
+        const bottom = Math.min(viewRect.bottom, canvasRect.bottom) - canvasRect.top;
+        const tilePx = TILE_SIZE * zoomLevel;
+        return {
+            x0: Math.max(0, Math.floor(left / tilePx)), x1: Math.min(TILES_X - 1, Math.floor((right - 1) / tilePx)),
+            y0: Math.max(0, Math.floor(top / tilePx)), y1: Math.min(TILES_Y - 1, Math.floor((bottom - 1) / tilePx)),
+        };
+    }
+
+    function loadVisibleTiles() {
+        const range = visibleTileRange();
+        for (let ty = range.y0; ty <= range.y1; ty++) {
+            for (let tx = range.x0; tx <= range.x1; tx++) {
+                if (staleTiles.has(`${tx},${ty}`)) loadTile(tx, ty);
+            }
+        }
+    }
+
+    async function loadTile(tx, ty) {
+        const key = `${tx},${ty}`;
+        if (loadingTiles.has(key)) return;
+        loadingTiles.set(key, []);
+        try {
+            const response = await fetch(`/canvas/${CANVAS_ID}/tile/${tx}/${ty}.rgb`);
+            if (!response.ok) return;
+            const bytes = new Uint8Array(await response.arrayBuffer());
+            const x0 = tx * TILE_SIZE, y0 = ty * TILE_SIZE;
+            const w = Math.min(TILE_SIZE, GRID_WIDTH - x0);
+            const hex = (b) => b.toString(16).padStart(2, '0');
+            for (let i = 0; i < bytes.length; i += 3) {
+                const p = i / 3;
+                canvasData[y0 + Math.floor(p / w)][x0 + (p % w)] = `#${hex(bytes[i])}${hex(bytes[i + 1])}${hex(bytes[i + 2])}`;
+            }
+            const pending = loadingTiles.get(key);
+            for (let i = 0; i < pending.length; i += 3) canvasData[pending[i + 1]][pending[i]] = pending[i + 2];
+            staleTiles.delete(key);
+            scheduleRedraw();
+        } finally {
+            loadingTiles.delete(key);
+        }
+    }
+
+    function isTileLoaded(gridX, gridY) {
+        return !staleTiles.has(`${Math.floor(gridX / TILE_SIZE)},${Math.floor(gridY / TILE_SIZE)}`);
+    }
+
+    function scheduleRedraw() {
+        if (redrawPending) return;
+        redrawPending = true;
+        requestAnimationFrame(() => {
+            redrawPending = false;
+            redrawCanvas();
+        });
+    }
+
     // --- Drawing & Canvas Functions ---
     function updateCanvasSize() {
         canvas.width = GRID_WIDTH * zoomLevel;
         canvas.height = GRID_HEIGHT * zoomLevel;
         redrawCanvas();
+        loadVisibleTiles();
     }
 
     function drawGrid() {
@@ -93,6 +214,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function placePixel(gridX, gridY) {
         if (gridX < 0 || gridX >= GRID_WIDTH || gridY < 0 || gridY >= GRID_HEIGHT) return;
+        if (!isTileLoaded(gridX, gridY)) return;
         if (canvasData[gridY][gridX] === selectedColor) return;
         
         canvasData[gridY][gridX] = selectedColor;
@@ -100,12 +222,37 @@ document.addEventListener('DOMContentLoaded', () => {
         pixelsToLog.push({ x: gridX, y: gridY, color: selectedColor });
     }
 
+    function applyTool(points) {
+        socket.emit('apply_tool', { pub_id: PUB_ID, canvas_id: CANVAS_ID, tool: tool, points: points, color: selectedColor });
+    }
+
+    function drawShapePreview(end) {
+        // Outline of the line/rectangle being dragged; the real pixels arrive in the server's tool_applied frame.
+        redrawCanvas();
+        const half = zoomLevel / 2;
+        ctx.strokeStyle = selectedColor;
+        ctx.lineWidth = Math.max(1, zoomLevel / 2);
+        ctx.beginPath();
+        if (tool === 'line') {
+            ctx.moveTo(shapeStart.x * zoomLevel + half, shapeStart.y * zoomLevel + half);
+            ctx.lineTo(end.x * zoomLevel + half, end.y * zoomLevel + half);
+        } else {
+            const x = Math.min(shapeStart.x, end.x), y = Math.min(shapeStart.y, end.y);
+            ctx.rect(x * zoomLevel, y * zoomLevel, (Math.abs(end.x - shapeStart.x) + 1) * zoomLevel, (Math.abs(end.y - shapeStart.y) + 1) * zoomLevel);
+        }
+        ctx.stroke();
+    }
+
+    function clampCoords(coords) {
+        return { x: Math.min(GRID_WIDTH - 1, Math.max(0, coords.x)), y: Math.min(GRID_HEIGHT - 1, Math.max(0, coords.y)) };
+    }
+
     function saveAndLog() {
         if (pixelsToLog.length > 0) {
             socket.emit('log_pixel_history', { canvas_id: CANVAS_ID, pixels: pixelsToLog });
             pixelsToLog = [];
         }
-        socket.emit('save_canvas_state', { canvas_id: CANVAS_ID, canvas_data: canvasData });
+        socket.emit('save_canvas_state', { canvas_id: CANVAS_ID });
     }
     
     // --- Event Listeners ---
@@ -118,6 +265,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
         colorPicker.addEventListener('input', (e) => selectedColor = e.target.value);
         gridToggle.addEventListener('change', redrawCanvas);
+        canvasWrapper.addEventListener('scroll', loadVisibleTiles);
+        window.addEventListener('resize', loadVisibleTiles);
         zoomSlider.addEventListener('input', (e) => {
             zoomLevel = parseInt(e.target.value, 10);
             updateCanvasSize();
@@ -134,14 +283,27 @@ document.addEventListener('DOMContentLoaded', () => {
             link.click();
         });
 
+        if (timelapseBtn) timelapseBtn.addEventListener('click', exportTimelapse);
+        if (toolSelect) toolSelect.addEventListener('change', (e) => tool = e.target.value);
+
         canvas.addEventListener('mousedown', (e) => {
+            if (tool === 'fill') {
+                applyTool([getCoords(e)]);
+                return;
+            }
+            if (tool !== 'brush') {
+                shapeStart = clampCoords(getCoords(e));
+                return;
+            }
             isDrawing = true;
             applyBrush(getCoords(e).x, getCoords(e).y);
             redrawCanvas();
         });
         
         canvas.addEventListener('mousemove', (e) => { 
-            if (isDrawing) {
+            if (shapeStart) {
+                drawShapePreview(clampCoords(getCoords(e)));
+            } else if (isDrawing) {
                 applyBrush(getCoords(e).x, getCoords(e).y);
                 redrawCanvas();
             } else {
@@ -149,7 +311,12 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         });
         
-        document.addEventListener('mouseup', () => {
+        document.addEventListener('mouseup', (e) => {
+            if (shapeStart) {
+                applyTool([shapeStart, clampCoords(getCoords(e))]);
+                shapeStart = null;
+                redrawCanvas();
+            }
             if (isDrawing) {
                 isDrawing = false;
                 saveAndLog();
@@ -174,6 +341,22 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    async function exportTimelapse() {
+        // The server renders the frames in the background; poll until the ZIP is ready, then download it.
+        timelapseBtn.disabled = true;
+        try {
+            const job = await (await fetch(`/canvas/${CANVAS_ID}/timelapse`, { method: 'POST' })).json();
+            let status = { status: 'running' };
+            while (status.status === 'running') {
+                await new Promise((resolve) => setTimeout(resolve, 2000));
+                status = await (await fetch(job.status_url)).json();
+            }
+            if (status.status === 'done') window.location = job.download_url;
+        } finally {
+            timelapseBtn.disabled = false;
+        }
+    }
+
     function getCoords(event) {
         const rect = canvas.getBoundingClientRect();
         const mouseX = event.clientX - rect.left;